@@ -0,0 +1,324 @@
+"""
+Offline benchmark for the Permissions cog.
+
+Builds a bot with fake servers, roles, channels and members, fills it with
+    rules and locks through the cog's own mutation paths and measures check
+    latency, mutation throughput and save cost. Nothing connects to Discord.
+
+Run it from the root of a Red install (cogs.utils has to be importable) with
+    discord.py and tabulate installed:
+
+    python path/to/permissions/bench.py --output before.json
+
+Results are printed as JSON, compare two runs to spot regressions.
+"""
+
+import argparse
+import asyncio
+import gc
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import discord
+from discord.ext import commands
+
+
+class Settings:
+    owner = "owner"
+
+
+# permissions.py does `from __main__ import send_cmd_help, settings`
+settings = Settings()
+# The cog module, imported once we're in the scratch directory
+perm_mod = None
+
+
+async def send_cmd_help(ctx):
+    pass
+
+
+class FakeRole:
+    def __init__(self, id, position, server):
+        self.id = id
+        self.name = "role{}".format(id)
+        self.position = position
+        self.server = server
+
+
+class FakeChannel:
+    def __init__(self, id, server):
+        self.id = id
+        self.name = "chan{}".format(id)
+        self.mention = "<#{}>".format(id)
+        self.server = server
+        self.is_private = False
+
+
+class FakeServer:
+    def __init__(self, id, roles, channels):
+        self.id = id
+        self.name = "server{}".format(id)
+        self.unavailable = False
+        self.roles = [FakeRole("{}.{}".format(id, i), i, self)
+                      for i in range(roles)]
+        self.channels = [FakeChannel("{}.c{}".format(id, i), self)
+                         for i in range(channels)]
+        self._channels = {c.id: c for c in self.channels}
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+
+class FakeMember:
+    def __init__(self, id, server, roles):
+        self.id = id
+        self.name = "member{}".format(id)
+        self.server = server
+        self.roles = roles
+
+
+class FakeMessage:
+    def __init__(self, author, channel):
+        self.author = author
+        self.channel = channel
+        self.server = channel.server
+        self.content = ""
+
+
+def make_cogs(n_commands, per_group=10, per_cog=10):
+    """
+    n_commands dotted commands as groups of per_group (the group and its
+        subcommands), per_cog groups to a cog.
+    """
+    async def callback(*args, **kwargs):
+        pass
+
+    cogs = []
+    attrs = {}
+    made = 0
+    while made < n_commands:
+        name = "g{}".format(made // per_group)
+        group = commands.Group(name=name, callback=callback,
+                               invoke_without_command=True)
+        attrs[name] = group
+        made += 1
+        for i in range(min(per_group - 1, n_commands - made)):
+            sub = commands.Command(name="s{}".format(i), callback=callback)
+            group.add_command(sub)
+            attrs["{}_s{}".format(name, i)] = sub
+            made += 1
+        if len(attrs) >= per_cog * per_group or made >= n_commands:
+            cog = type("Cog{}".format(len(cogs)), (), attrs)
+            cogs.append(cog())
+            attrs = {}
+    return cogs
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def at(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    return {"count": len(samples),
+            "mean_us": sum(samples) / len(samples) * 1e6,
+            "p50_us": at(0.50) * 1e6,
+            "p90_us": at(0.90) * 1e6,
+            "p99_us": at(0.99) * 1e6,
+            "max_us": samples[-1] * 1e6}
+
+
+async def populate(perm, bot, servers, all_cmds, rng, rules, locks):
+    """
+    Rules and mixed locks through the mutation paths, timed.
+    """
+    cog_names = sorted(bot.cogs)
+    timings = []
+    for server in servers:
+        for _ in range(rules):
+            roll = rng.random()
+            allow = rng.random() < 0.5
+            if roll < 0.1:
+                target = rng.choice(cog_names[:-1])
+            elif roll < 0.15:
+                cmd = rng.choice(all_cmds)
+                target = perm._get_scope(
+                    cmd.qualified_name.split(" ")[0] + ".*")
+            else:
+                target = rng.choice(all_cmds)
+            if rng.random() < 0.5:
+                kwargs = {"role": rng.choice(server.roles[1:])}
+            else:
+                kwargs = {"channel": rng.choice(server.channels)}
+            start = time.perf_counter()
+            await perm._set_permission(target, server, allow=allow, **kwargs)
+            timings.append(time.perf_counter() - start)
+        for _ in range(locks):
+            cmd = rng.choice(all_cmds).qualified_name.replace(" ", ".")
+            start = time.perf_counter()
+            if rng.random() < 0.5:
+                await perm._lock_server(cmd, server)
+            else:
+                await perm._lock_channel(cmd, rng.choice(server.channels))
+            timings.append(time.perf_counter() - start)
+
+    for cmd in rng.sample(all_cmds, min(5, len(all_cmds))):
+        await perm._lock_global(cmd.qualified_name.replace(" ", "."), None)
+    await perm._lock_cog(None, cog_names[-1])
+    return timings
+
+
+def run_checks(perm, bot, servers, all_cmds, rng, n_checks, members):
+    """
+    Builds n_checks contexts up front and times each check on them.
+    """
+    contexts = []
+    for _ in range(n_checks):
+        server = rng.choice(servers)
+        roles = [server.roles[0]] + rng.sample(server.roles[1:],
+                                               min(members,
+                                                   len(server.roles) - 1))
+        author = FakeMember(str(rng.randrange(10 ** 6)), server, roles)
+        message = FakeMessage(author, rng.choice(server.channels))
+        command = rng.choice(all_cmds)
+        # Commands nothing was set for have no Check, time one anyway
+        check = perm_mod.Check(command)
+        ctx = commands.Context(message=message, bot=bot, command=command,
+                               prefix="!")
+        contexts.append((check, ctx))
+
+    timings = []
+    for check, ctx in contexts:
+        start = time.perf_counter()
+        check(ctx)
+        timings.append(time.perf_counter() - start)
+    return contexts, timings
+
+
+def time_saves(perm):
+    shard_timings = []
+    for writer in list(perm._shard_writers.values()):
+        writer.mark_dirty()
+        start = time.perf_counter()
+        writer.flush()
+        shard_timings.append(time.perf_counter() - start)
+    perm._global_writer.mark_dirty()
+    start = time.perf_counter()
+    perm._global_writer.flush()
+    global_time = time.perf_counter() - start
+
+    shard_bytes = sum(os.path.getsize(perm._shard_path(server_id))
+                      for server_id in perm._shard_writers)
+    return {"shards": percentiles(shard_timings),
+            "shards_total_s": sum(shard_timings),
+            "shards_bytes": shard_bytes,
+            "global_s": global_time,
+            "global_bytes": os.path.getsize(perm_mod.GLOBAL_PATH)}
+
+
+def main(args):
+    global perm_mod
+    rng = random.Random(args.seed)
+    loop = asyncio.get_event_loop()
+
+    workdir = tempfile.mkdtemp(prefix="permbench")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        os.makedirs("data")
+        perm_mod = importlib.import_module("permissions")
+
+        bot = commands.Bot(command_prefix="!", loop=loop)
+        for cog in make_cogs(args.commands):
+            bot.add_cog(cog)
+        servers = [FakeServer(str(i), args.roles, args.channels)
+                   for i in range(args.servers)]
+        for server in servers:
+            bot.connection._add_server(server)
+        bot._is_ready.set()
+
+        perm = perm_mod.Permissions(bot)
+        bot.add_cog(perm)
+        all_cmds = [cmd for cmd in perm._command_index.values()
+                    if cmd.cog_name != "Permissions"]
+
+        start = time.perf_counter()
+        mutation_timings = loop.run_until_complete(
+            populate(perm, bot, servers, all_cmds, rng, args.rules,
+                     args.locks))
+        mutation_total = time.perf_counter() - start
+        # Let the startup tasks run so they don't land inside the checks
+        loop.run_until_complete(asyncio.sleep(0))
+
+        gc.collect()
+        perm._invalidate()
+        contexts, cold = run_checks(perm, bot, servers, all_cmds, rng,
+                                    args.checks, args.member_roles)
+        warm = []
+        for check, ctx in contexts:
+            start = time.perf_counter()
+            check(ctx)
+            warm.append(time.perf_counter() - start)
+
+        results = {
+            "version": 1,
+            "python": platform.python_version(),
+            "discord.py": discord.__version__,
+            "params": vars(args),
+            # cold is the first pass over every context with nothing cached
+            #   or compiled, warm is the same contexts again
+            "checks": {"cold": percentiles(cold),
+                       "warm": percentiles(warm),
+                       "cache_hits": perm.decision_cache.hits,
+                       "cache_misses": perm.decision_cache.misses},
+            "mutations": dict(percentiles(mutation_timings),
+                              total_s=mutation_total,
+                              per_second=len(mutation_timings) /
+                              mutation_total),
+            "saves": time_saves(perm),
+            "shards_loaded": len(perm.shards),
+        }
+        for writer in perm._shard_writers.values():
+            writer.cancel()
+        perm._global_writer.cancel()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--servers", type=int, default=1000)
+    parser.add_argument("--roles", type=int, default=500,
+                        help="roles per server")
+    parser.add_argument("--channels", type=int, default=50,
+                        help="channels per server")
+    parser.add_argument("--commands", type=int, default=2000)
+    parser.add_argument("--rules", type=int, default=20,
+                        help="rules set per server")
+    parser.add_argument("--locks", type=int, default=3,
+                        help="server/channel locks per server")
+    parser.add_argument("--checks", type=int, default=100000)
+    parser.add_argument("--member-roles", type=int, default=5,
+                        help="roles per checking member besides @everyone")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the JSON here")
+    main(parser.parse_args())
@@ -1,14 +1,21 @@
 import discord
 from discord.ext import commands
+import aiohttp
 from discord.ext.commands import CommandNotFound
 from cogs.utils.dataIO import dataIO
 from cogs.utils import checks
-from cogs.utils.chat_formatting import box
+from cogs.utils.chat_formatting import box, pagify
 import os
+import sys
 import logging
-import copy
 import asyncio
+import bisect
 import itertools
+import collections
+import json
+import tempfile
+import threading
+import time
 
 try:
     from tabulate import tabulate
@@ -19,6 +26,13 @@ from __main__ import send_cmd_help, settings
 
 log = logging.getLogger("red.permissions")
 
+GLOBAL_PATH = "data/permissions/global.json"
+SHARD_DIR = "data/permissions/servers"
+# Single file storage from before the per server shards
+LEGACY_PERMS_PATH = "data/permissions/perms.json"
+LEGACY_LOCKS_PATH = "data/permissions/locks.json"
+STATS_PATH = "data/permissions/stats.json"
+
 
 class PermissionsError(CommandNotFound):
     """
@@ -37,7 +51,22 @@ class RoleNotFound(PermissionsError):
     """
     Thrown when we can't get a valid role from a list and given name
     """
-    pass
+
+    def __init__(self, server, role):
+        # CommandError wants a string message, not the server
+        super().__init__("Role {} not found".format(role))
+        self.server = server
+        self.role = role
+
+
+class BulkError(PermissionsError):
+    """
+    Thrown when a p bulk script has bad lines, holds (line, reason) pairs
+    """
+
+    def __init__(self, errors):
+        super().__init__("{} bad lines".format(len(errors)))
+        self.errors = errors
 
 
 class SpaceNotation(BadCommand):
@@ -49,6 +78,628 @@ class SpaceNotation(BadCommand):
     pass
 
 
+class DecisionCache:
+    """
+    Memoizes the outcome of Permissions.resolve_permission. Entries are keyed
+        by (command, server, channel, author's role ID's) and nested by server
+        then command so that invalidation only drops what actually changed.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # server id -> command -> (channel id, frozenset of role ids) -> bool
+        self._entries = {}
+
+    def get(self, command, server_id, channel_id, role_ids):
+        try:
+            ret = self._entries[server_id][command][(channel_id, role_ids)]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return ret
+
+    def put(self, command, server_id, channel_id, role_ids, has_perm):
+        if self.size >= self.max_size:
+            self.clear()
+        per_server = self._entries.setdefault(server_id, {})
+        per_command = per_server.setdefault(command, {})
+        key = (channel_id, role_ids)
+        if key not in per_command:
+            self.size += 1
+        per_command[key] = has_perm
+
+    def invalidate(self, server_id=None, command=None):
+        if server_id is None and command is None:
+            self.clear()
+        elif command is None:
+            per_server = self._entries.pop(server_id, {})
+            self.size -= sum(len(v) for v in per_server.values())
+        elif server_id is None:
+            for per_server in self._entries.values():
+                self.size -= len(per_server.pop(command, ()))
+        else:
+            per_server = self._entries.get(server_id, {})
+            self.size -= len(per_server.pop(command, ()))
+
+    def clear(self):
+        self._entries = {}
+        self.size = 0
+
+
+class WriteBehind:
+    """
+    Saves a JSON file some time after it was marked dirty so that bursts of
+        changes end up as one write. Serializing and writing happen in the
+        loop's default executor, through a temp file that is renamed over the
+        real one so a crash never leaves a half written file behind.
+
+    `snapshot` is called on the event loop and must return data that nothing
+        else will mutate.
+    """
+
+    def __init__(self, loop, path, snapshot, delay=2.0):
+        self.loop = loop
+        self.path = path
+        self.snapshot = snapshot
+        self.delay = delay
+
+        self.pending = 0
+        self.writes = 0
+        self.last_latency = 0.0
+        self.total_latency = 0.0
+
+        self._task = None
+        self._seq = 0
+        self._written_seq = 0
+        self._write_lock = threading.Lock()
+
+    @property
+    def avg_latency(self):
+        return self.total_latency / self.writes if self.writes else 0.0
+
+    def mark_dirty(self):
+        self.pending += 1
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._write_later())
+
+    def cancel(self):
+        """
+        Drops pending changes, for files that are about to be deleted.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.pending = 0
+
+    def flush(self):
+        """
+        Writes synchronously if anything is pending, for use on unload.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.pending:
+            self.pending = 0
+            self._seq += 1
+            self._write(self.snapshot(), self._seq)
+
+    async def save(self):
+        """
+        Writes now if anything is pending, in the executor like the delayed
+            write. Errors are logged and the changes stay pending.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.pending:
+            pending = self.pending
+            self.pending = 0
+            self._seq += 1
+            try:
+                await self.loop.run_in_executor(None, self._write,
+                                                self.snapshot(), self._seq)
+            except Exception:
+                log.exception("Failed to save {}".format(self.path))
+                self.pending += pending
+
+    async def _write_later(self):
+        await asyncio.sleep(self.delay)
+        while self.pending:
+            pending = self.pending
+            self.pending = 0
+            self._seq += 1
+            try:
+                await self.loop.run_in_executor(None, self._write,
+                                                self.snapshot(), self._seq)
+            except asyncio.CancelledError:
+                # save or flush took over, the write itself still finishes
+                raise
+            except Exception:
+                log.exception("Failed to save {}".format(self.path))
+                self.pending += pending
+                return
+
+    def _write(self, data, seq):
+        start = time.perf_counter()
+        with self._write_lock:
+            if seq < self._written_seq:
+                # A newer snapshot already made it to disk (flush on unload)
+                return
+            dirname = os.path.dirname(self.path) or "."
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(data, f, indent=4, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            self._written_seq = seq
+        self.last_latency = time.perf_counter() - start
+        self.total_latency += self.last_latency
+        self.writes += 1
+        log.debug("saved {} in {:.1f}ms".format(self.path,
+                                                self.last_latency * 1000))
+
+
+class CheckStats:
+    """
+    Counters and timing histograms of permission checks, per command and per
+        server. Nothing is recorded while disabled, callers test enabled
+        before they even start a timer.
+    """
+    # Upper bounds of the histogram buckets in microseconds, the last bucket
+    #   takes everything slower.
+    BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        # name -> [checks, denied, histogram]
+        self.commands = {}
+        self.servers = {}
+        # Time spent computing decisions the cache didn't have
+        self.resolve_hist = [0] * (len(self.BUCKETS) + 1)
+        self.overrides = 0
+
+    def _bucket(self, elapsed):
+        return bisect.bisect_left(self.BUCKETS, elapsed * 1000000)
+
+    def record_check(self, command, server_id, allowed, elapsed):
+        bucket = self._bucket(elapsed)
+        for table, key in ((self.commands, command),
+                           (self.servers, server_id)):
+            try:
+                entry = table[key]
+            except KeyError:
+                entry = table[key] = [0, 0, [0] * (len(self.BUCKETS) + 1)]
+            entry[0] += 1
+            if not allowed:
+                entry[1] += 1
+            entry[2][bucket] += 1
+
+    def record_resolve(self, elapsed):
+        self.resolve_hist[self._bucket(elapsed)] += 1
+
+    @classmethod
+    def percentile(cls, hist, p):
+        """
+        Upper bound of the bucket the p-th percentile falls in, in
+            microseconds, None for the overflow bucket.
+        """
+        total = sum(hist)
+        if not total:
+            return 0
+        seen = 0
+        for bound, count in zip(cls.BUCKETS + (None, ), hist):
+            seen += count
+            if seen >= total * p:
+                return bound
+
+    @staticmethod
+    def _entry_json(entry):
+        checks, denied, hist = entry
+        return {"checks": checks, "denied": denied, "histogram": hist}
+
+    def top(self, table, n=10):
+        return sorted(table.items(), key=lambda kv: kv[1][0],
+                      reverse=True)[:n]
+
+    def to_json(self):
+        return {"since": self.since,
+                "buckets_us": list(self.BUCKETS),
+                "commands": {k: self._entry_json(v)
+                             for k, v in self.commands.items()},
+                "servers": {k: self._entry_json(v)
+                            for k, v in self.servers.items()},
+                "resolve_histogram": self.resolve_hist,
+                "owner_overrides": self.overrides}
+
+
+class LockTable:
+    """
+    The locks that don't belong to a single server, commands in dot notation:
+        GLOBAL   - commands locked everywhere
+        COGS     - cog names whose commands are all locked
+        CHANNELS - channel id -> commands, channel locks from before sharding
+                   whose server wasn't known when they were migrated
+    Server and channel locks otherwise live in each server's ServerPerms.
+    """
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.commands = set(data.get("GLOBAL", []))
+        self.cogs = set(data.get("COGS", []))
+        self.channels = {chanid: set(cmds)
+                         for chanid, cmds in data.get("CHANNELS", {}).items()}
+
+    @staticmethod
+    def from_legacy(perms):
+        """
+        Pulls the old per command "LOCKS" entries out of perms (modifying it)
+            and returns them in the flat locks.json format.
+        """
+        ret = {"GLOBAL": [], "COGS": [], "SERVERS": {}, "CHANNELS": {}}
+        cogs = set()
+        for command in list(perms):
+            locks = perms[command].pop("LOCKS", None)
+            if not perms[command]:
+                del perms[command]
+            if locks is None:
+                continue
+            if locks.get("GLOBAL", False):
+                ret["GLOBAL"].append(command)
+            cogs.update(locks.get("COGS", []))
+            for key in ("SERVERS", "CHANNELS"):
+                for lock_id, lock in locks.get(key, {}).items():
+                    if lock:
+                        ret[key].setdefault(lock_id, []).append(command)
+        ret["COGS"] = sorted(cogs)
+        return ret
+
+    def covers(self, command, cog_name=None):
+        """
+        Whether a global, cog or unassigned channel lock could apply to
+            command.
+        """
+        return (command in self.commands or cog_name in self.cogs or
+                any(command in cmds for cmds in self.channels.values()))
+
+    def is_locked(self, command, cog_name, channel_id):
+        return (command in self.commands or
+                cog_name in self.cogs or
+                command in self.channels.get(channel_id, ()))
+
+    def set_cog(self, cog_name, lock=True):
+        if lock:
+            self.cogs.add(cog_name)
+        else:
+            self.cogs.discard(cog_name)
+
+    def set_global(self, command, lock=True):
+        if lock:
+            self.commands.add(command)
+        else:
+            self.commands.discard(command)
+
+    def to_json(self):
+        return {"GLOBAL": sorted(self.commands),
+                "COGS": sorted(self.cogs),
+                "CHANNELS": {chanid: sorted(cmds)
+                             for chanid, cmds in self.channels.items()}}
+
+
+class PatternTrie:
+    """
+    Wildcard scopes ("*", "playlist.*", ...) stored by their dotted prefix.
+        A pattern matches every command below its prefix, "*" matches every
+        command.
+    """
+    __slots__ = ("children", "pattern")
+
+    def __init__(self):
+        self.children = {}
+        self.pattern = None
+
+    @staticmethod
+    def is_pattern(scope):
+        return scope == "*" or scope.endswith(".*")
+
+    def add(self, pattern):
+        node = self
+        for part in pattern.split(".")[:-1]:
+            node = node.children.setdefault(part, PatternTrie())
+        node.pattern = pattern
+
+    def remove(self, pattern):
+        path = []
+        node = self
+        for part in pattern.split(".")[:-1]:
+            path.append((node, part))
+            node = node.children.get(part)
+            if node is None:
+                return
+        node.pattern = None
+        # Prune the branch back up while it leads nowhere
+        while path and node.pattern is None and not node.children:
+            parent, part = path.pop()
+            del parent.children[part]
+            node = parent
+
+    def matches(self, command):
+        """
+        Patterns that match command, most specific first.
+        """
+        found = []
+        node = self
+        if node.pattern is not None:
+            found.append(node.pattern)
+        for part in command.split(".")[:-1]:
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.pattern is not None:
+                found.append(node.pattern)
+        found.reverse()
+        return found
+
+
+class ScopeRules:
+    """
+    The channel and role rules of one scope, id -> True (allow) or False
+        (deny). Older files stored "+scope"/"-scope" strings, those are
+        still read.
+    """
+    __slots__ = ("channels", "roles")
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.channels = self._load(data.get("CHANNELS"))
+        self.roles = self._load(data.get("ROLES"))
+
+    @staticmethod
+    def _load(entries):
+        if not entries:
+            return {}
+        # Every role and channel id shows up under many scopes, interning
+        #   keeps one copy of each.
+        return {sys.intern(target_id): (status.startswith("+")
+                                        if isinstance(status, str)
+                                        else bool(status))
+                for target_id, status in entries.items()}
+
+    def __len__(self):
+        return len(self.channels) + len(self.roles)
+
+    def of(self, kind):
+        return self.channels if kind == "CHANNELS" else self.roles
+
+    def to_json(self):
+        # Bools are immutable so copying the dicts is enough for the writer
+        #   thread to never see a change in flight.
+        return {"CHANNELS": dict(self.channels), "ROLES": dict(self.roles)}
+
+
+class RuleSet:
+    """
+    Channel and role rules keyed by scope, a scope being a command in dot
+        notation or a cog name. Keeps an inverted index of
+        ("CHANNELS"|"ROLES", id) -> scopes with a rule for that channel/role.
+    """
+
+    def __init__(self, data=None):
+        # scope -> ScopeRules
+        self.rules = {}
+        self.targets = {}
+        self.patterns = PatternTrie()
+        for scope, per_scope in (data or {}).items():
+            scope = sys.intern(scope)
+            per_scope = self.rules[scope] = ScopeRules(per_scope)
+            if PatternTrie.is_pattern(scope):
+                self.patterns.add(scope)
+            for kind in ("CHANNELS", "ROLES"):
+                for target_id in per_scope.of(kind):
+                    self.targets.setdefault((kind, target_id),
+                                            set()).add(scope)
+
+    def __contains__(self, scope):
+        return scope in self.rules
+
+    def clear(self):
+        self.rules = {}
+        self.targets = {}
+        self.patterns = PatternTrie()
+
+    def get(self, scope):
+        return self.rules.get(scope)
+
+    def remove_rule(self, scope, kind, target_id):
+        try:
+            del self.rules[scope].of(kind)[target_id]
+        except KeyError:
+            return False
+        scopes = self.targets.get((kind, target_id), set())
+        scopes.discard(scope)
+        if not scopes:
+            self.targets.pop((kind, target_id), None)
+        return True
+
+    def remove_scope(self, scope):
+        """
+        Drops every rule of a scope, returns how many there were.
+        """
+        per_scope = self.rules.pop(scope, None) or ScopeRules()
+        if PatternTrie.is_pattern(scope):
+            self.patterns.remove(scope)
+        removed = 0
+        for kind in ("CHANNELS", "ROLES"):
+            entries = per_scope.of(kind)
+            for target_id in entries:
+                scopes = self.targets.get((kind, target_id), set())
+                scopes.discard(scope)
+                if not scopes:
+                    self.targets.pop((kind, target_id), None)
+            removed += len(entries)
+        return removed
+
+    def remove_empty(self):
+        """
+        Drops scopes that no longer have any rule, returns how many.
+        """
+        empty = [scope for scope, per_scope in self.rules.items()
+                 if not per_scope]
+        for scope in empty:
+            self.remove_scope(scope)
+        return len(empty)
+
+    def remove_target(self, kind, target_id):
+        """
+        Drops every rule of a channel or role, returns the scopes that had
+            one.
+        """
+        scopes = self.targets.pop((kind, target_id), set())
+        for scope in scopes:
+            del self.rules[scope].of(kind)[target_id]
+        return scopes
+
+    def set_rule(self, scope, kind, target_id, allow):
+        try:
+            per_scope = self.rules[scope]
+        except KeyError:
+            scope = sys.intern(scope)
+            per_scope = self.rules[scope] = ScopeRules()
+            if PatternTrie.is_pattern(scope):
+                self.patterns.add(scope)
+        target_id = sys.intern(target_id)
+        per_scope.of(kind)[target_id] = allow
+        self.targets.setdefault((kind, target_id), set()).add(scope)
+
+    def to_json(self):
+        return {scope: per_scope.to_json()
+                for scope, per_scope in self.rules.items()}
+
+
+class ServerPerms:
+    """
+    One server's shard: command rules, cog wide rules, and its server and
+        channel locks. Saved as data/permissions/servers/<server id>.json
+    """
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.commands = RuleSet(data.get("RULES"))
+        self.cogs = RuleSet(data.get("COGS"))
+        locks = data.get("LOCKS", {})
+        self.locked = set(locks.get("SERVER", []))
+        self.channel_locks = {chanid: set(cmds) for chanid, cmds in
+                              locks.get("CHANNELS", {}).items()}
+
+    def clear(self):
+        """
+        What `p reset` wipes, server locks are kept.
+        """
+        self.commands.clear()
+        self.cogs.clear()
+        self.channel_locks = {}
+
+    def is_locked(self, command, channel_id):
+        return (command in self.locked or
+                command in self.channel_locks.get(channel_id, ()))
+
+    def set_channel_lock(self, channel_id, command, lock=True):
+        if lock:
+            self.channel_locks.setdefault(channel_id, set()).add(command)
+        else:
+            cmds = self.channel_locks.get(channel_id, set())
+            cmds.discard(command)
+            if not cmds:
+                self.channel_locks.pop(channel_id, None)
+
+    def set_server_lock(self, command, lock=True):
+        if lock:
+            self.locked.add(command)
+        else:
+            self.locked.discard(command)
+
+    def to_json(self):
+        channel_locks = {chanid: sorted(cmds)
+                         for chanid, cmds in self.channel_locks.items()}
+        return {"RULES": self.commands.to_json(),
+                "COGS": self.cogs.to_json(),
+                "LOCKS": {"SERVER": sorted(self.locked),
+                          "CHANNELS": channel_locks}}
+
+
+class CommandTable:
+    """
+    Compiled rules of one scope (command or cog) on a single server. `allow`
+        and `deny` are bitsets over the server's role indexes (see
+        CompiledServer).
+    """
+    __slots__ = ("allow", "deny", "channels")
+
+    def __init__(self, allow=0, deny=0, channels=None):
+        self.allow = allow
+        self.deny = deny
+        self.channels = channels or {}
+
+
+# Shared table for scopes without any rules on a server.
+CommandTable.EMPTY = CommandTable()
+
+
+class RoleHierarchy:
+    """
+    Position ordering of a server's roles. First item in `ordered` is
+        @\u200Beveryone, a role's rank is its index in `ordered`.
+    """
+
+    def __init__(self, roles):
+        self.ordered = sorted(roles, key=lambda r: r.position)
+        self.ranks = {r.id: i for i, r in enumerate(self.ordered)}
+
+    def rank(self, role):
+        return self.ranks.get(role.id, -1)
+
+
+class CompiledServer:
+    """
+    Bitset decision tables for one server. Every role gets the bit of its
+        rank in the RoleHierarchy (@\u200Beveryone is bit 0) so the highest
+        role a member has that matches a rule is the highest set bit of
+        (allow | deny) & member_bits.
+    """
+
+    def __init__(self, hierarchy):
+        self.role_bits = {roleid: 1 << rank
+                          for roleid, rank in hierarchy.ranks.items()}
+        # command -> tuple of CommandTables to consult in order (the command's
+        #   own rules, matching wildcards from most to least specific, then
+        #   its cog's), filled lazily and dropped per command
+        self.tables = {}
+        # cog name -> CommandTable
+        self.cog_tables = {}
+        # wildcard pattern -> CommandTable
+        self.pattern_tables = {}
+
+    def get_table(self, command):
+        return self.tables.get(command)
+
+    def member_bits(self, roles):
+        bits = 0
+        get = self.role_bits.get
+        for role in roles:
+            bits |= get(role.id, 0)
+        return bits
+
+
 class Check:
     """
     This is what we're going to stick into the checks for Command objects
@@ -66,21 +717,31 @@ class Check:
         elif ctx.message.channel.is_private:
             return True
 
+        stats = perm_cog.stats
+        if stats.enabled:
+            start = time.perf_counter()
         has_perm = perm_cog.resolve_permission(ctx)
 
-        if has_perm:
-            log.debug("user {} allowed to execute {}"
-                      " chid {}".format(ctx.message.author.name,
-                                        ctx.command.qualified_name,
-                                        ctx.message.channel.id))
-        else:
-            log.debug("user {} not allowed to execute {}"
-                      " chid {}".format(ctx.message.author.name,
-                                        ctx.command.qualified_name,
-                                        ctx.message.channel.id))
+        # Formatting these on every check adds up, skip it unless shown
+        if log.isEnabledFor(logging.DEBUG):
+            if has_perm:
+                log.debug("user {} allowed to execute {}"
+                          " chid {}".format(ctx.message.author.name,
+                                            ctx.command.qualified_name,
+                                            ctx.message.channel.id))
+            else:
+                log.debug("user {} not allowed to execute {}"
+                          " chid {}".format(ctx.message.author.name,
+                                            ctx.command.qualified_name,
+                                            ctx.message.channel.id))
 
         can_run = has_perm or author.id == self.owner_id
 
+        if stats.enabled:
+            stats.record_check(self.command, ctx.message.server.id, has_perm,
+                               time.perf_counter() - start)
+            if can_run and not has_perm:
+                stats.overrides += 1
         return can_run
 
     @property
@@ -98,47 +759,185 @@ class Permissions:
     def __init__(self, bot):
         self.bot = bot
 
-        # All the saved permission levels with role ID's
-        self.perms_we_want = self._load_perms()
-        self.perm_lock = asyncio.Lock()
-
-        self.check_adder = bot.loop.create_task(self.add_checks_to_all())
+        # Global/cog locks and the commands that have something set on any
+        #   server. Everything else lives in per server shards (ServerPerms)
+        #   that are loaded the first time they're needed.
+        self.locks = LockTable()
+        self.commands_with_perms = set()
+        self.cogs_with_perms = set()
+        self.shards = {}
+        self._shard_ids = set()
+        self._shard_writers = {}
+        self._startup_tasks = []
+        self._load_perms()
+        self._global_writer = WriteBehind(bot.loop, GLOBAL_PATH,
+                                          self._snapshot_global)
+        # server id -> asyncio.Lock, edits on one server never wait on
+        #   another's. global_lock guards the global and cog locks.
+        self.server_locks = collections.defaultdict(asyncio.Lock)
+        self.global_lock = asyncio.Lock()
+        self.decision_cache = DecisionCache()
+        # server id -> CompiledServer
+        self.compiled = {}
+        # server id -> RoleHierarchy
+        self.role_index = {}
+
+        # Checks are installed when a rule is first added and whenever
+        #   commands get registered, so we watch the bot's command registry.
+        self._registry_hooks = {}
+        self._hook_command_registry()
+
+        # Dot notation -> command object, and cog name -> {dot: command}.
+        #   Both include subcommands and follow the command registry.
+        self._command_index = {}
+        self._cog_index = {}
+        loaded = list(self._walk_commands(bot.commands.values()))
+        self._index_commands(loaded)
+        self._install_checks(loaded)
 
     def __unload(self):
-        if self.check_adder:
-            self.check_adder.cancel()
+        for task in self._startup_tasks:
+            task.cancel()
+        self._unhook_command_registry()
+        self._global_writer.flush()
+        for writer in self._shard_writers.values():
+            writer.flush()
+
+        for cmd in self._command_index.values():
+            keepers = [c for c in cmd.checks if not isinstance(c, Check)]
+            cmd.checks = keepers
+
+    def _command_added(self, command):
+        cmds = list(self._walk_commands([command]))
+        self._index_commands(cmds)
+        self._install_checks(cmds)
+        for cmd in cmds:
+            self._invalidate(command=cmd.qualified_name.replace(" ", "."))
+
+    def _command_removed(self, command, name):
+        if command is None or name != command.name:
+            # Nothing removed or only an alias was
+            return
+        cmds = list(self._walk_commands([command]))
+        self._unindex_commands(cmds)
+        for cmd in cmds:
+            self._invalidate(command=cmd.qualified_name.replace(" ", "."))
 
-        for cmd_dot in self.perms_we_want:
+    def _hook_command_registry(self):
+        """
+        Wraps bot.add_command and bot.remove_command, which is what add_cog
+            and remove_cog go through, so (re)loaded commands get their checks
+            without us polling for them.
+        """
+        bot = self.bot
+        original_add = bot.__dict__.get("add_command")
+        original_remove = bot.__dict__.get("remove_command")
+        call_add = original_add or bot.add_command
+        call_remove = original_remove or bot.remove_command
+
+        def add_command(command):
+            ret = call_add(command)
+            self._command_added(command)
+            return ret
+
+        def remove_command(name):
+            ret = call_remove(name)
+            self._command_removed(ret, name)
+            return ret
+
+        bot.add_command = add_command
+        bot.remove_command = remove_command
+        self._registry_hooks = {"add_command": (add_command, original_add),
+                                "remove_command": (remove_command,
+                                                   original_remove)}
+
+    def _unhook_command_registry(self):
+        for attr, (hook, original) in self._registry_hooks.items():
+            # Only put the original back if nobody wrapped us in the meantime
+            if self.bot.__dict__.get(attr) is not hook:
+                continue
+            if original is None:
+                delattr(self.bot, attr)
+            else:
+                setattr(self.bot, attr, original)
+        self._registry_hooks = {}
+
+    def _index_commands(self, cmds):
+        for cmd in cmds:
+            cmd_dot = cmd.qualified_name.replace(" ", ".")
+            self._command_index[cmd_dot] = cmd
+            if cmd.cog_name is not None:
+                self._cog_index.setdefault(cmd.cog_name, {})[cmd_dot] = cmd
+
+    def _unindex_commands(self, cmds):
+        for cmd in cmds:
+            cmd_dot = cmd.qualified_name.replace(" ", ".")
+            if self._command_index.get(cmd_dot) is cmd:
+                del self._command_index[cmd_dot]
+            per_cog = self._cog_index.get(cmd.cog_name, {})
+            if per_cog.get(cmd_dot) is cmd:
+                del per_cog[cmd_dot]
+                if not per_cog:
+                    del self._cog_index[cmd.cog_name]
+
+    def _get_pattern_commands(self, pattern):
+        """
+        Every loaded command a wildcard pattern applies to.
+        """
+        prefix = pattern[:-1]
+        return [cmd for cmd_dot, cmd in self._command_index.items()
+                if cmd_dot.startswith(prefix)]
+
+    def _get_cog_commands(self, cog_name):
+        """
+        Every command of a cog, subcommands included.
+        """
+        return list(self._cog_index.get(cog_name, {}).values())
+
+    def _install_check(self, cmd_dot, cmd_obj=None):
+        if cmd_obj is None:
             try:
-                cmd = self._get_command(cmd_dot)
+                cmd_obj = self._get_command(cmd_dot)
             except BadCommand:
-                # Just means the command couldn't be found which is okay
-                #   because we're unloading anyways.
-                pass
-            else:
-                keepers = [c for c in cmd.checks if not isinstance(c, Check)]
-                cmd.checks = keepers
-
-    async def _check_perm_entry(self, command, server):
-        await self.perm_lock.acquire()
-        if command not in self.perms_we_want:
-            self.perms_we_want[command] = {"LOCKS": {"GLOBAL": False,
-                                                     "SERVERS": {},
-                                                     "CHANNELS": {}}}
-
-        if server.id not in self.perms_we_want[command]:
-            self.perms_we_want[command][server.id] = {"CHANNELS": {},
-                                                      "ROLES": {}}
-
-        if "LOCKS" not in self.perms_we_want[command]:
-            self.perms_we_want[command]["LOCKS"] = {"GLOBAL": False,
-                                                    "COGS": [],
-                                                    "SERVERS": {},
-                                                    "CHANNELS": {}}
-
-        if "COGS" not in self.perms_we_want[command]["LOCKS"]:
-            self.perms_we_want[command]["LOCKS"]["COGS"] = []
-        self.perm_lock.release()
+                # Command is not loaded, it gets its check when it is
+                return
+        if not any(isinstance(c, Check) for c in cmd_obj.checks):
+            log.debug("Check object not found in {}, adding".format(cmd_dot))
+            cmd_obj.checks.append(Check(cmd_dot))
+
+    def _install_checks(self, cmds):
+        """
+        Adds a Check to every command in cmds that has permissions set up.
+        """
+        for cmd_obj in cmds:
+            cmd_dot = cmd_obj.qualified_name.replace(" ", ".")
+            if cmd_dot in self.commands_with_perms or \
+                    cmd_obj.cog_name in self.cogs_with_perms or \
+                    self._has_pattern_perms(cmd_dot) or \
+                    self.locks.covers(cmd_dot, cmd_obj.cog_name):
+                self._install_check(cmd_dot, cmd_obj)
+
+    def _has_pattern_perms(self, cmd_dot):
+        parts = cmd_dot.split(".")
+        for i in range(len(parts)):
+            if ".".join(parts[:i] + ["*"]) in self.commands_with_perms:
+                return True
+        return False
+
+    def _walk_commands(self, cmds):
+        """
+        Yields every command in cmds and all of their subcommands once,
+            aliases are skipped.
+        """
+        seen = set()
+        stack = list(cmds)
+        while stack:
+            cmd = stack.pop()
+            if id(cmd) in seen:
+                continue
+            seen.add(id(cmd))
+            yield cmd
+            stack.extend(getattr(cmd, "commands", {}).values())
 
     def _error_raise(exc):
         def deco(func):
@@ -170,31 +969,128 @@ class Permissions:
                                         " playlist.add instead of \"playlist"
                                         " add\")")
 
+    def _compile_rules(self, compiled, per_scope):
+        if per_scope is None:
+            return CommandTable.EMPTY
+
+        allow = deny = 0
+        for roleid, allowed in per_scope.roles.items():
+            bit = compiled.role_bits.get(roleid, 0)
+            if allowed:
+                allow |= bit
+            else:
+                deny |= bit
+
+        channels = dict(per_scope.channels)
+
+        if not allow and not deny and not channels:
+            return CommandTable.EMPTY
+        return CommandTable(allow, deny, channels)
+
+    def _compile_table(self, compiled, server, command, cog_name=None):
+        """
+        Compiles the layers that apply to command on server, command level
+            rules first, then wildcard rules from most to least specific and
+            cog level rules last, and stores them in compiled.
+        """
+        shard = self._get_shard(server.id)
+        if shard is None:
+            compiled.tables[command] = ()
+            return ()
+
+        layers = []
+        table = self._compile_rules(compiled, shard.commands.get(command))
+        if table is not CommandTable.EMPTY:
+            layers.append(table)
+
+        for pattern in shard.commands.patterns.matches(command):
+            try:
+                table = compiled.pattern_tables[pattern]
+            except KeyError:
+                table = self._compile_rules(compiled,
+                                            shard.commands.get(pattern))
+                compiled.pattern_tables[pattern] = table
+            if table is not CommandTable.EMPTY:
+                layers.append(table)
+
+        if cog_name is not None:
+            try:
+                table = compiled.cog_tables[cog_name]
+            except KeyError:
+                table = self._compile_rules(compiled,
+                                            shard.cogs.get(cog_name))
+                compiled.cog_tables[cog_name] = table
+            if table is not CommandTable.EMPTY:
+                layers.append(table)
+
+        layers = tuple(layers)
+        compiled.tables[command] = layers
+        return layers
+
+    def _get_compiled(self, server):
+        try:
+            return self.compiled[server.id]
+        except KeyError:
+            compiled = CompiledServer(self._get_hierarchy(server))
+            self.compiled[server.id] = compiled
+            return compiled
+
     @_error_raise(BadCommand)
     def _get_command(self, cmd_string):
+        try:
+            return self._command_index[cmd_string]
+        except KeyError:
+            # Aliases and subcommands added to a group at runtime aren't
+            #   indexed, walk the tree for those.
+            pass
         cmd = cmd_string.split('.')
         ret = self.bot.commands[cmd.pop(0)]
         while len(cmd) > 0:
             ret = ret.commands[cmd.pop(0)]
         return ret
 
+    def _get_scope(self, command):
+        """
+        Turns what an admin typed into what _set_permission and
+            _reset_permission take: a command object, a cog name, or a
+            wildcard pattern like playlist.* whose prefix is a command.
+        """
+        if command == "*":
+            return command
+        if PatternTrie.is_pattern(command):
+            prefix = command[:-2]
+            if not prefix:
+                # ".*", a wildcard under no command at all
+                raise BadCommand()
+            prefix = self._get_command(prefix).qualified_name.replace(" ", ".")
+            return prefix + ".*"
+        try:
+            return self._get_command(command)
+        except BadCommand as e:
+            if command in self.bot.cogs:
+                return command
+            raise e
+
     async def _get_info(self, server, command):
-        await self.perm_lock.acquire()
-        command = command.qualified_name.replace(' ', '.')
+        with (await self.server_locks[server.id]):
+            shard = self._get_shard(server.id) or ServerPerms()
+            per_server = shard.commands.get(command) or ScopeRules()
+            # Names are looked up from a copy, outside the lock
+            per_server = per_server.to_json()
 
-        per_server = self.perms_we_want[command][server.id]
         ret = {"CHANNELS": [], "ROLES": []}
-        for chanid, status in per_server["CHANNELS"].items():
+        for chanid, allowed in per_server["CHANNELS"].items():
             chan = self.bot.get_channel(chanid)
             if chan:
-                allowed = self._is_allow(status)
                 allow_str = "Allowed" if allowed else "Denied"
                 ret["CHANNELS"].append((chan.name, allow_str))
 
-        for roleid, status in per_server["ROLES"].items():
-            role = self._get_role_from_id(server, roleid)
+        for roleid, allowed in per_server["ROLES"].items():
+            try:
+                role = self._get_role_from_id(server, roleid)
+            except RoleNotFound:
+                continue
             if role:
-                allowed = self._is_allow(status)
                 allow_str = "Allowed" if allowed else "Denied"
                 ret["ROLES"].append((role.name, allow_str))
 
@@ -203,10 +1099,231 @@ class Permissions:
 
         role_sort = sorted(ret["ROLES"], key=lambda r: r[0])
         ret["ROLES"] = role_sort
-        self.perm_lock.release()
 
         return ret
 
+    def _get_shard(self, server_id, create=False, stats=None):
+        """
+        Returns the ServerPerms of server_id, loading (and compacting) it from
+            disk the first time. Returns None if the server has nothing set
+            up, unless create is True.
+        """
+        try:
+            return self.shards[server_id]
+        except KeyError:
+            pass
+
+        if server_id in self._shard_ids:
+            shard = ServerPerms(dataIO.load_json(self._shard_path(server_id)))
+            self.shards[server_id] = shard
+            # Whatever went stale while the shard sat on disk goes now
+            server = self._get_server_from_id(server_id)
+            if stats is None:
+                stats = collections.Counter()
+            if server is not None and \
+                    self._compact_shard(server, shard, stats):
+                self._save_shard(server_id)
+        elif create:
+            shard = ServerPerms()
+            self._shard_ids.add(server_id)
+            self.shards[server_id] = shard
+        else:
+            return None
+        return shard
+
+    def _compact_shard(self, server, shard, stats, commands=False):
+        """
+        Prunes rules and locks of roles and channels that no longer exist on
+            server and scopes left without rules. With commands, also those
+            of commands and cogs that aren't loaded. Counts go into stats,
+            returns whether anything was removed.
+        """
+        if getattr(server, "unavailable", False):
+            # Roles and channels of an outage server can't be trusted
+            return False
+        before = sum(stats.values())
+        alive = {"ROLES": {r.id for r in server.roles},
+                 "CHANNELS": {c.id for c in server.channels}}
+
+        for rule_set in (shard.commands, shard.cogs):
+            for kind, target_id in list(rule_set.targets):
+                if target_id not in alive[kind]:
+                    removed = rule_set.remove_target(kind, target_id)
+                    stats[kind.lower()] += len(removed)
+
+        for chanid in list(shard.channel_locks):
+            if chanid not in alive["CHANNELS"]:
+                stats["locks"] += len(shard.channel_locks.pop(chanid))
+
+        if commands:
+            for scope in list(shard.commands.rules):
+                if PatternTrie.is_pattern(scope):
+                    # A wildcard lives as long as the command it hangs off
+                    if scope == "*" or scope[:-2] in self._command_index:
+                        continue
+                elif scope in self._command_index:
+                    continue
+                stats["commands"] += 1
+                stats["entries"] += shard.commands.remove_scope(scope)
+            for scope in list(shard.cogs.rules):
+                if scope not in self.bot.cogs:
+                    stats["cogs"] += 1
+                    stats["entries"] += shard.cogs.remove_scope(scope)
+            dead = {cmd for cmd in shard.locked
+                    if cmd not in self._command_index}
+            for cmds in shard.channel_locks.values():
+                dead.update(cmd for cmd in cmds
+                            if cmd not in self._command_index)
+            for cmd in dead:
+                shard.set_server_lock(cmd, False)
+                for chanid in list(shard.channel_locks):
+                    shard.set_channel_lock(chanid, cmd, False)
+            stats["locks"] += len(dead)
+
+        stats["empty"] += shard.commands.remove_empty()
+        stats["empty"] += shard.cogs.remove_empty()
+        return sum(stats.values()) > before
+
+    async def _collect_garbage(self, load=False, commands=False,
+                               drop_servers=False):
+        """
+        Compacts shards one at a time, yielding to the loop in between.
+            With drop_servers, shards of servers we're no longer in are
+            deleted. Without load only shards that are already in memory are
+            compacted (the rest get it when they're loaded), with load every
+            shard is read and the global command/cog lists are rebuilt from
+            what's left. Shards loaded just for this are evicted again.
+        """
+        stats = collections.Counter()
+        servers = {s.id: s for s in self.bot.servers}
+        manifest = (set(), set())
+
+        for server_id in list(self._shard_ids):
+            server = servers.get(server_id)
+            if server is None and drop_servers:
+                self._drop_shard(server_id)
+                stats["servers"] += 1
+            elif load or server_id in self.shards:
+                with (await self.server_locks[server_id]):
+                    resident = server_id in self.shards
+                    shard = self._get_shard(server_id, stats=stats)
+                    if server is not None and \
+                            self._compact_shard(server, shard, stats,
+                                                commands):
+                        self._invalidate(server)
+                        self._save_shard(server_id)
+                    if load:
+                        self._add_to_manifest(shard, *manifest)
+                        if not resident:
+                            await self._evict_shard(server_id)
+            await asyncio.sleep(0)
+
+        if load:
+            self._rebuild_manifest(*manifest)
+        stats = +stats  # Drops the zero counts
+        log.info("Permissions garbage collection removed {}".format(
+            dict(stats)))
+        return stats
+
+    def _drop_shard(self, server_id):
+        self.shards.pop(server_id, None)
+        self._shard_ids.discard(server_id)
+        writer = self._shard_writers.pop(server_id, None)
+        if writer is not None:
+            writer.cancel()
+        try:
+            os.remove(self._shard_path(server_id))
+        except FileNotFoundError:
+            pass
+        self._invalidate(server_id)
+
+    async def _evict_shard(self, server_id):
+        """
+        Writes out and forgets a loaded shard, it is read again from disk the
+            next time it's needed. A shard changed while it was being written
+            stays loaded.
+        """
+        writer = self._shard_writers.get(server_id)
+        if writer is not None:
+            await writer.save()
+            if writer.pending:
+                return
+            # The writer snapshots this very shard, so it can't outlive it
+            del self._shard_writers[server_id]
+        self.shards.pop(server_id, None)
+
+    @staticmethod
+    def _add_to_manifest(shard, commands, cogs):
+        commands.update(shard.commands.rules)
+        commands.update(shard.locked)
+        for cmds in shard.channel_locks.values():
+            commands.update(cmds)
+        cogs.update(shard.cogs.rules)
+
+    def _rebuild_manifest(self, commands, cogs):
+        """
+        Replaces commands_with_perms and cogs_with_perms with what was
+            collected from every shard by _add_to_manifest.
+        """
+        commands.update(itertools.chain.from_iterable(
+            self.locks.channels.values()))
+        if commands != self.commands_with_perms or \
+                cogs != self.cogs_with_perms:
+            self.commands_with_perms = commands
+            self.cogs_with_perms = cogs
+            self._save_global()
+
+    async def _startup_gc(self):
+        await self.bot.wait_until_ready()
+        await self._collect_garbage()
+
+    def _shard_path(self, server_id):
+        return os.path.join(SHARD_DIR, "{}.json".format(server_id))
+
+    def _get_server_info(self, server):
+        """
+        Rows of (type, name, command, status) for every rule and lock on
+            server, built from the shard's target index so each channel and
+            role is only resolved once.
+        """
+        shard = self._get_shard(server.id)
+        if shard is None:
+            return []
+
+        rows = []
+        for rule_set, suffix in ((shard.commands, ""), (shard.cogs, " (cog)")):
+            for (kind, target_id), scopes in rule_set.targets.items():
+                if kind == "CHANNELS":
+                    target = self.bot.get_channel(target_id)
+                else:
+                    target = discord.utils.get(server.roles, id=target_id)
+                if target is None:
+                    continue
+                kind_str = "Channel" if kind == "CHANNELS" else "Role"
+                for scope in scopes:
+                    allowed = rule_set.rules[scope].of(kind)[target_id]
+                    rows.append((kind_str, target.name, scope + suffix,
+                                 "Allowed" if allowed else "Denied"))
+
+        for command in shard.locked:
+            rows.append(("Server", server.name, command, "Locked"))
+        for chanid, cmds in shard.channel_locks.items():
+            chan = self.bot.get_channel(chanid)
+            if chan is None:
+                continue
+            for command in cmds:
+                rows.append(("Channel", chan.name, command, "Locked"))
+
+        return sorted(rows)
+
+    def _get_hierarchy(self, server):
+        try:
+            return self.role_index[server.id]
+        except KeyError:
+            hierarchy = RoleHierarchy(server.roles)
+            self.role_index[server.id] = hierarchy
+            return hierarchy
+
     def _get_ordered_role_list(self, server=None, roles=None):
         """
         First item in ordered list is @\u200Beveryone, e.g. the highest role
@@ -216,16 +1333,10 @@ class Permissions:
             raise PermissionsError("Must supply either server or role.")
 
         if server:
-            roles = server.roles
-        else:
-            server = roles[0].server
-
-        ordered_roles = sorted(roles, key=lambda r: r.position)
-
-        log.debug("Ordered roles for sid {}:\n\t{}".format(server.id,
-                                                           ordered_roles))
+            return list(self._get_hierarchy(server).ordered)
 
-        return sorted(roles, key=lambda r: r.position)
+        hierarchy = self._get_hierarchy(roles[0].server)
+        return sorted(roles, key=hierarchy.rank)
 
     def _get_role(self, roles, role_string):
         if role_string.lower() == "everyone":
@@ -257,139 +1368,217 @@ class Permissions:
     def _get_server_from_id(self, serverid):
         return discord.utils.get(self.bot.servers, id=serverid)
 
+    def _invalidate(self, server=None, command=None):
+        """
+        Drops cached permission decisions. Pass nothing to drop everything,
+            a server to drop that server, a command (dot notation) to drop it
+            on every server, or both.
+        """
+        server_id = getattr(server, "id", server)
+        self.decision_cache.invalidate(server_id, command)
+
+        # Compiled tables are rebuilt lazily on the next check, a whole server
+        #   only when its roles changed or it was reset.
+        if server_id is None and command is None:
+            self.compiled = {}
+        elif command is None:
+            self.compiled.pop(server_id, None)
+        elif server_id is None:
+            for compiled in self.compiled.values():
+                compiled.tables.pop(command, None)
+        elif server_id in self.compiled:
+            self.compiled[server_id].tables.pop(command, None)
+
     def _has_higher_role(self, member, role):
-        server = member.server
-        roles = self._get_ordered_role_list(server=server)
-        try:
-            role_index = roles.index(role)
-        except ValueError:
-            # Role isn't in the ordered role list
+        hierarchy = self._get_hierarchy(member.server)
+        role_rank = hierarchy.rank(role)
+        if role_rank == -1:
+            # Role isn't in the server's hierarchy
             return False
 
-        higher_roles = roles[role_index + 1:]
-
-        if any([r in higher_roles for r in member.roles]):
-            return True
-        return False
+        return any(hierarchy.rank(r) > role_rank for r in member.roles)
 
-    def _is_allow(self, permission):
-        if permission.startswith("+"):
+    def _is_locked(self, command, server, channel, cog_name=None):
+        if cog_name is None:
+            cmd_obj = self._command_index.get(command)
+            cog_name = getattr(cmd_obj, "cog_name", None)
+        if self.locks.is_locked(command, cog_name, channel.id):
             return True
-        return False
-
-    def _is_locked(self, command, server, channel):
-        locks = self.perms_we_want[command].get("LOCKS", None)
+        shard = self._get_shard(server.id)
+        return shard is not None and shard.is_locked(command, channel.id)
 
-        if locks is None:
-            return False
-
-        global_lock = locks["GLOBAL"]
-        server_lock = locks["SERVERS"].get(server.id, False)
-        channel_lock = locks["CHANNELS"].get(channel.id, False)
-
-        cog_name = self._get_command(command).cog_name
-        cog_lock = cog_name in locks.get("COGS", set())
+    def _load_perms(self):
+        if not os.path.exists(SHARD_DIR):
+            os.makedirs(SHARD_DIR)
 
-        return global_lock or cog_lock or server_lock or channel_lock
+        if os.path.exists(LEGACY_PERMS_PATH):
+            self._migrate_legacy()
 
-    def _load_perms(self):
         try:
-            ret = dataIO.load_json("data/permissions/perms.json")
+            data = dataIO.load_json(GLOBAL_PATH)
         except:
-            ret = {}
-            if not os.path.exists("data/permissions"):
-                os.mkdir("data/permissions")
-            dataIO.save_json("data/permissions/perms.json", ret)
-        return ret
+            data = {}
+            dataIO.save_json(GLOBAL_PATH, data)
+        self.locks = LockTable(data.get("LOCKS"))
+        self.commands_with_perms = set(data.get("COMMANDS", []))
+        self.cogs_with_perms = set(data.get("COGS", []))
+        self.stats = CheckStats(data.get("STATS", False))
+
+        self._shard_ids = {os.path.splitext(f)[0]
+                           for f in os.listdir(SHARD_DIR)
+                           if f.endswith(".json")}
+
+        if self.locks.channels:
+            self._startup_tasks.append(
+                self.bot.loop.create_task(self._assign_channel_locks()))
+        self._startup_tasks.append(
+            self.bot.loop.create_task(self._startup_gc()))
+
+    def _migrate_legacy(self):
+        """
+        Splits the single perms.json (and locks.json) into per server shards
+            in one pass, the old files are kept with a .bak suffix.
+        """
+        perms = dataIO.load_json(LEGACY_PERMS_PATH)
+        if os.path.exists(LEGACY_LOCKS_PATH):
+            locks = dataIO.load_json(LEGACY_LOCKS_PATH)
+        else:
+            locks = LockTable.from_legacy(perms)
+
+        shards = {}
+        commands = set()
+        for command, per_command in perms.items():
+            for server_id, per_server in per_command.items():
+                shard = shards.setdefault(server_id, ServerPerms())
+                shard.commands.rules[command] = ScopeRules(per_server)
+                commands.add(command)
+
+        for server_id, cmds in locks.get("SERVERS", {}).items():
+            shard = shards.setdefault(server_id, ServerPerms())
+            shard.locked.update(cmds)
+            commands.update(cmds)
+
+        # Channel ids don't tell us their server until we're connected,
+        #   those are handed to their shard by _assign_channel_locks.
+        for cmds in locks.get("CHANNELS", {}).values():
+            commands.update(cmds)
+
+        for server_id, shard in shards.items():
+            dataIO.save_json(self._shard_path(server_id), shard.to_json())
+        dataIO.save_json(GLOBAL_PATH, {"LOCKS": LockTable(locks).to_json(),
+                                       "COMMANDS": sorted(commands)})
+
+        for path in (LEGACY_PERMS_PATH, LEGACY_LOCKS_PATH):
+            if os.path.exists(path):
+                os.replace(path, path + ".bak")
+        log.info("Migrated permissions of {} servers into shards".format(
+            len(shards)))
+
+    async def _assign_channel_locks(self):
+        await self.bot.wait_until_ready()
+        for channel_id in list(self.locks.channels):
+            channel = self.bot.get_channel(channel_id)
+            if channel is None or channel.is_private:
+                continue
+            cmds = self.locks.channels.pop(channel_id)
+            shard = self._get_shard(channel.server.id, create=True)
+            for command in cmds:
+                shard.set_channel_lock(channel_id, command)
+            self._save_shard(channel.server.id)
+        self._save_global()
 
     async def _lock_channel(self, command, channel, lock=True):
-        await self._check_perm_entry(command, channel.server)
-
-        with (await self.perm_lock):
-            self.perms_we_want[command]["LOCKS"]["CHANNELS"][channel.id] = lock
-
-        self._save_perms()
+        server = channel.server
+        with (await self.server_locks[server.id]):
+            shard = self._get_shard(server.id, create=True)
+            shard.set_channel_lock(channel.id, command, lock)
+            legacy_locks = False
+            if not lock:
+                legacy = self.locks.channels.get(channel.id, set())
+                if command in legacy:
+                    legacy.discard(command)
+                    legacy_locks = True
+            self._note_command(command)
+
+        self._install_check(command)
+        self._invalidate(server, command)
+        self._save_shard(server.id)
+        if legacy_locks:
+            self._save_global()
 
     async def _lock_cog(self, server, cogname, lock=True):
-        cmds = list(filter(lambda c: c.cog_name == cogname,
-                           self.bot.commands.values()))
-        for cmd_name in cmds:
-            command = cmd_name.qualified_name.replace(" ", ".")
-            await self._check_perm_entry(command, server)
-            await self.perm_lock.acquire()
-            if lock:
-                if cogname not in \
-                        self.perms_we_want[command]["LOCKS"]["COGS"]:
-                    self.perms_we_want[command]["LOCKS"]["COGS"].append(
-                        cogname)
-            else:
-                try:
-                    self.perms_we_want[command]["LOCKS"]["COGS"].remove(
-                        cogname)
-                except Exception:
-                    # Cog wasn't locked
-                    pass
-            self.perm_lock.release()
+        with (await self.global_lock):
+            self.locks.set_cog(cogname, lock)
 
-        self._save_perms()
+        for cmd in self._get_cog_commands(cogname):
+            command = cmd.qualified_name.replace(" ", ".")
+            self._install_check(command, cmd)
+            self._invalidate(command=command)
+        self._save_global()
 
     async def _lock_global(self, command, server, lock=True):
-        await self._check_perm_entry(command, server)
+        with (await self.global_lock):
+            self.locks.set_global(command, lock)
 
-        with (await self.perm_lock):
-            self.perms_we_want[command]["LOCKS"]["GLOBAL"] = lock
-
-        self._save_perms()
+        self._install_check(command)
+        self._invalidate(command=command)
+        self._save_global()
 
     async def _lock_server(self, command, server, lock=True):
-        await self._check_perm_entry(command, server)
-
-        with (await self.perm_lock):
-            self.perms_we_want[command]["LOCKS"]["SERVERS"][server.id] = lock
+        with (await self.server_locks[server.id]):
+            shard = self._get_shard(server.id, create=True)
+            shard.set_server_lock(command, lock)
+            self._note_command(command)
 
-        self._save_perms()
+        self._install_check(command)
+        self._invalidate(server, command)
+        self._save_shard(server.id)
 
-    async def _reset(self, server):
-        await self.perm_lock.acquire()
-        for cmd in self.perms_we_want:
-            try:
-                del self.perms_we_want[cmd][server.id]
-            except KeyError:
-                pass
+    def _note_command(self, command):
+        """
+        Remembers that command has something set on some server so it gets a
+            Check when it loads, without having to read every shard.
+        """
+        if command not in self.commands_with_perms:
+            self.commands_with_perms.add(command)
+            self._save_global()
 
-            for chan in server.channels:
-                try:
-                    del self.perms_we_want[cmd]["LOCKS"]["CHANNELS"][chan.id]
-                except KeyError:
-                    pass
-        self.perm_lock.release()
-        self._save_perms()
+    def _note_cog(self, cog_name):
+        if cog_name not in self.cogs_with_perms:
+            self.cogs_with_perms.add(cog_name)
+            self._save_global()
 
-    async def _reset_channel(self, command, server, channel):
+    def _note_rule(self, command):
+        """
+        _note_command or _note_cog for a rule set through _put_rule.
+        """
         try:
-            command = command.qualified_name.replace(' ', '.')
+            cmd_dot_name = command.qualified_name.replace(" ", ".")
         except AttributeError:
-            # If we pass a cog name in as command
-            cmds = list(filter(lambda c: c.cog_name == command,
-                               self.bot.commands.values()))
-            for cmd in cmds:
-                await self._reset_channel(cmd, server, channel)
-            return
-        if command not in self.perms_we_want:
-            return
-
-        await self.perm_lock.acquire()
-        cmd_perms = self.perms_we_want[command]
-        if server.id not in cmd_perms:
-            return
+            if PatternTrie.is_pattern(command):
+                self._note_command(command)
+            else:
+                self._note_cog(command)
+        else:
+            self._note_command(cmd_dot_name)
 
-        try:
-            del self.perms_we_want[command][server.id]["CHANNELS"][channel.id]
-        except KeyError:
-            pass
+    async def _reset(self, server):
+        with (await self.server_locks[server.id]):
+            shard = self._get_shard(server.id)
+            if shard is not None:
+                shard.clear()
+            legacy_locks = False
+            for chan in server.channels:
+                if self.locks.channels.pop(chan.id, None) is not None:
+                    legacy_locks = True
+        self._invalidate(server)
+        if shard is not None:
+            self._save_shard(server.id)
+        if legacy_locks:
+            self._save_global()
 
-        self.perm_lock.release()
-        self._save_perms()
+    async def _reset_channel(self, command, server, channel):
+        await self._reset_rule(command, server, "CHANNELS", channel.id)
 
     async def _reset_permission(self, command, server, channel=None,
                                 role=None):
@@ -399,124 +1588,178 @@ class Permissions:
             await self._reset_role(command, server, role)
 
     async def _reset_role(self, command, server, role):
+        await self._reset_rule(command, server, "ROLES", role.id)
+
+    async def _reset_rule(self, command, server, kind, target_id):
+        """Command can be a command object, cog name or wildcard (string)"""
+        with (await self.server_locks[server.id]):
+            shard = self._get_shard(server.id)
+            if shard is None:
+                return
+            cmd_dot_name, changed = self._drop_rule(shard, command, kind,
+                                                    target_id)
+
+        if changed:
+            self._invalidate(server, cmd_dot_name)
+            self._save_shard(server.id)
+
+    def _drop_rule(self, shard, command, kind, target_id):
+        """
+        Removes one rule from shard, nothing else. Returns command in dot
+            notation (None for cogs and wildcards) and whether there was a
+            rule to remove.
+        """
         try:
-            command = command.qualified_name.replace(' ', '.')
+            cmd_dot_name = command.qualified_name.replace(" ", ".")
         except AttributeError:
-            # If we pass a cog name in as command
-            cmds = list(filter(lambda c: c.cog_name == command,
-                               self.bot.commands.values()))
-            for cmd in cmds:
-                self._reset_role(cmd, server, role)
-            return
-
-        await self.perm_lock.acquire()
-        if command not in self.perms_we_want:
-            return
-
-        cmd_perms = self.perms_we_want[command]
-        if server.id not in cmd_perms:
-            return
-
-        try:
-            del self.perms_we_want[command][server.id]["ROLES"][role.id]
-        except KeyError:
             pass
-        self.perm_lock.release()
+        else:
+            return cmd_dot_name, shard.commands.remove_rule(cmd_dot_name,
+                                                            kind, target_id)
 
-        self._save_perms()
+        if PatternTrie.is_pattern(command):
+            changed = shard.commands.remove_rule(command, kind, target_id)
+            cmds = []
+        else:
+            # If we pass a cog name in as command, per command rules are
+            #   dropped too since cog rules used to be stored that way.
+            changed = shard.cogs.remove_rule(command, kind, target_id)
+            cmds = self._get_cog_commands(command)
+        for cmd in cmds:
+            cmd_dot_name = cmd.qualified_name.replace(" ", ".")
+            changed |= shard.commands.remove_rule(cmd_dot_name, kind,
+                                                  target_id)
+        return None, changed
 
     def resolve_permission(self, ctx):
         command = ctx.command.qualified_name.replace(' ', '.')
         server = ctx.message.server
         channel = ctx.message.channel
-        roles = reversed(self._get_ordered_role_list(
-            roles=ctx.message.author.roles))
+        author_roles = ctx.message.author.roles
+        role_ids = frozenset(r.id for r in author_roles)
+
+        has_perm = self.decision_cache.get(command, server.id, channel.id,
+                                           role_ids)
+        if has_perm is None:
+            if self.stats.enabled:
+                start = time.perf_counter()
+            has_perm = self._resolve_permission(command, server, channel,
+                                                author_roles,
+                                                ctx.command.cog_name)
+            if self.stats.enabled:
+                self.stats.record_resolve(time.perf_counter() - start)
+            self.decision_cache.put(command, server.id, channel.id, role_ids,
+                                    has_perm)
+        return has_perm
 
-        try:
-            per_command = self.perms_we_want[command]
-        except KeyError:
-            log.debug("{} not in perms_we_want".format(command))
-            return True
+    def resolve_many(self, ctx, cmds):
+        """
+        Resolves every command in cmds (command objects or dot notation) for
+            the author of ctx in one pass, the way their Check would. Returns
+            a dict of dot notation -> bool.
 
-        try:
-            per_server = per_command[server.id]
-        except KeyError:
-            # In this case the server is not in the perms we want to check
-            #   therefore we're just gonna assume the default "allow"
-            log.debug("sid {} not found for command {}".format(server.id,
-                                                               command))
-            return True
+        Meant for things like help formatters that filter a command list.
+        """
+        message = ctx.message
+        server = message.server
+        channel = message.channel
+        author = message.author
+
+        ret = {}
+        bypass = channel.is_private or author.id == settings.owner
+        compiled = None if bypass else self._get_compiled(server)
+        author_roles = getattr(author, "roles", [])
+        role_ids = frozenset(r.id for r in author_roles)
+        member_bits = None
+
+        for cmd in cmds:
+            if isinstance(cmd, str):
+                command = cmd
+                cmd = self._command_index.get(command)
+            else:
+                command = cmd.qualified_name.replace(" ", ".")
+            if bypass:
+                ret[command] = True
+                continue
+
+            has_perm = self.decision_cache.get(command, server.id, channel.id,
+                                               role_ids)
+            if has_perm is None:
+                if member_bits is None:
+                    member_bits = compiled.member_bits(author_roles)
+                has_perm = self._resolve_permission(
+                    command, server, channel, author_roles,
+                    getattr(cmd, "cog_name", None), compiled, member_bits)
+                self.decision_cache.put(command, server.id, channel.id,
+                                        role_ids, has_perm)
+            ret[command] = has_perm
+        return ret
 
-        channel_perm_dict = per_server["CHANNELS"]
-        role_perm_dict = per_server["ROLES"]
+    def _resolve_permission(self, command, server, channel, author_roles,
+                            cog_name=None, compiled=None, member_bits=None):
+        if self._is_locked(command, server, channel, cog_name):
+            return False
 
-        if channel.id not in channel_perm_dict:
-            # Again, assume default "allow"
-            log.debug("chanid {} not found, chan_perm = True".format(
-                channel.id))
-            channel_perm = True
-        else:
-            # We know that an admin has set permission on this channel
-            if self._is_allow(channel_perm_dict[channel.id]):
-                log.debug("chanid {} found and allowed".format(channel.id))
-                channel_perm = True
-            else:
-                log.debug("chanid {} found and denied".format(channel.id))
-                channel_perm = False
+        if compiled is None:
+            compiled = self._get_compiled(server)
+        layers = compiled.get_table(command)
+        if layers is None:
+            layers = self._compile_table(compiled, server, command, cog_name)
 
-        for role in roles:
-            if role.id in role_perm_dict:
-                if self._is_allow(role_perm_dict[role.id]):
-                    log.debug("role {} found and allowed".format(role.id))
-                    role_perm = True
-                    break
-                else:
-                    log.debug("role {} found and denied".format(role.id))
-                    role_perm = False
-                    break
+        if not layers:
+            # Nothing has been set for this command on this server so we
+            #   assume the default "allow"
+            return True
+
+        # The highest set bit of the matched roles is the highest role in the
+        #   hierarchy that has a rule, which is the one that wins. Command
+        #   rules are consulted before wildcard rules before cog rules.
+        if member_bits is None:
+            member_bits = compiled.member_bits(author_roles)
+        for table in layers:
+            matched = (table.allow | table.deny) & member_bits
+            if matched:
+                top = 1 << (matched.bit_length() - 1)
+                role_perm = bool(table.allow & top)
+                break
         else:
             # By doing this we let the channel perm override in the case of
             #   no role perms being set.
-            log.debug("role not found, ignoring roles")
             role_perm = None
 
-        is_locked = self._is_locked(command, server, channel)
+        channel_perm = True
+        for table in layers:
+            if channel.id in table.channels:
+                channel_perm = table.channels[channel.id]
+                break
 
         has_perm = ((role_perm is None and channel_perm) or
-                    (role_perm is True)) and not is_locked
-        log.debug("uid {} has perm: {}".format(ctx.message.author.id,
-                                               has_perm))
+                    (role_perm is True))
+        log.debug("%s in chid %s has perm: %s", command, channel.id, has_perm)
         return has_perm
 
-    def _save_perms(self):
-        dataIO.save_json('data/permissions/perms.json', self.perms_we_want)
+    def _save_global(self):
+        self._global_writer.mark_dirty()
 
-    async def _set_channel(self, command, server, channel, allow):
+    def _save_shard(self, server_id):
         try:
-            cmd_dot_name = command.qualified_name.replace(" ", ".")
-        except AttributeError:
-            # If we pass a cog name in as command
-            cmds = list(filter(lambda c: c.cog_name == command,
-                               self.bot.commands.values()))
-            for cmd in cmds:
-                await self._set_channel(cmd, server, channel, allow)
-            return
+            writer = self._shard_writers[server_id]
+        except KeyError:
+            shard = self.shards[server_id]
+            writer = WriteBehind(self.bot.loop, self._shard_path(server_id),
+                                 shard.to_json)
+            self._shard_writers[server_id] = writer
+        writer.mark_dirty()
+
+    def _snapshot_global(self):
+        return {"LOCKS": self.locks.to_json(),
+                "COMMANDS": sorted(self.commands_with_perms),
+                "COGS": sorted(self.cogs_with_perms),
+                "STATS": self.stats.enabled}
 
-        if allow:
-            allow = "+"
-        else:
-            allow = "-"
-
-        await self.perm_lock.acquire()
-        if cmd_dot_name not in self.perms_we_want:
-            self.perms_we_want[cmd_dot_name] = {}
-        if server.id not in self.perms_we_want[cmd_dot_name]:
-            self.perms_we_want[cmd_dot_name][server.id] = \
-                {"CHANNELS": {}, "ROLES": {}}
-        self.perms_we_want[cmd_dot_name][server.id]["CHANNELS"][channel.id] = \
-            "{}{}".format(allow, cmd_dot_name)
-        self.perm_lock.release()
-        self._save_perms()
+    async def _set_channel(self, command, server, channel, allow):
+        """Command can be a command object or cog name (string)"""
+        await self._set_rule(command, server, "CHANNELS", channel.id, allow)
 
     async def _set_permission(self, command, server, channel=None, role=None,
                               allow=True):
@@ -528,29 +1771,138 @@ class Permissions:
 
     async def _set_role(self, command, server, role, allow):
         """Command can be a command object or cog name (string)"""
+        await self._set_rule(command, server, "ROLES", role.id, allow)
+
+    async def _set_rule(self, command, server, kind, target_id, allow):
+        """
+        A cog name is stored once as a cog wide rule which covers every
+            command of the cog, including ones loaded later. Wildcards like
+            playlist.* work the same way for every command below playlist.
+        """
+        with (await self.server_locks[server.id]):
+            shard = self._get_shard(server.id, create=True)
+            cmd_dot_name, cmds = self._put_rule(shard, command, kind,
+                                                target_id, allow)
+            self._note_rule(command)
+
+        for cmd in cmds:
+            self._install_check(cmd.qualified_name.replace(" ", "."), cmd)
+        # A cog or wildcard rule touches many commands, drop the server.
+        self._invalidate(server, cmd_dot_name)
+        self._save_shard(server.id)
+
+    def _put_rule(self, shard, command, kind, target_id, allow):
+        """
+        Sets one rule in shard, nothing else, see _note_rule. Returns command
+            in dot notation (None for cogs and wildcards) and the loaded
+            commands that need a Check for it.
+        """
         try:
             cmd_dot_name = command.qualified_name.replace(" ", ".")
         except AttributeError:
-            # If we pass a cog name in as command
-            cmds = list(filter(lambda c: c.cog_name == command,
-                               self.bot.commands.values()))
-            for cmd in cmds:
-                await self._set_role(cmd, server, role, allow)
+            pass
         else:
-            if allow:
-                allow = "+"
+            shard.commands.set_rule(cmd_dot_name, kind, target_id, allow)
+            return cmd_dot_name, [command]
+
+        if PatternTrie.is_pattern(command):
+            shard.commands.set_rule(command, kind, target_id, allow)
+            return None, self._get_pattern_commands(command)
+        shard.cogs.set_rule(command, kind, target_id, allow)
+        cmds = self._get_cog_commands(command)
+        # Per command rules left over from when cog rules were stored that
+        #   way would still win over the cog rule.
+        for cmd in cmds:
+            shard.commands.remove_rule(cmd.qualified_name.replace(" ", "."),
+                                       kind, target_id)
+        return None, cmds
+
+    def _parse_bulk(self, server, script):
+        """
+        Turns a p bulk script into the changes _bulk_edit takes. Every line
+            is checked, raises BulkError listing all the bad ones.
+        """
+        actions = {"allow": True, "deny": False, "reset": None}
+        changes = []
+        errors = []
+        for lineno, line in enumerate(script.splitlines(), 1):
+            line = line.strip()
+            # Comments, and the fences of a pasted code block
+            if not line or line.startswith(("#", "```")):
+                continue
+            parts = line.split(None, 3)
+            if len(parts) < 4 or parts[0].lower() not in ("channel", "role") \
+                    or parts[1].lower() not in actions:
+                errors.append((lineno, "expected `role|channel"
+                                       " allow|deny|reset command target`"))
+                continue
+            kind, action, command, target = parts
+            try:
+                command = self._get_scope(command)
+            except BadCommand:
+                errors.append((lineno, "unknown command or cog "
+                                       "{}".format(command)))
+                continue
+            if kind.lower() == "role":
+                try:
+                    target_id = self._get_role(server.roles, target).id
+                except RoleNotFound:
+                    errors.append((lineno, "unknown role {}".format(target)))
+                    continue
+                kind = "ROLES"
             else:
-                allow = "-"
-            await self.perm_lock.acquire()
-            if cmd_dot_name not in self.perms_we_want:
-                self.perms_we_want[cmd_dot_name] = {}
-            if server.id not in self.perms_we_want[cmd_dot_name]:
-                self.perms_we_want[cmd_dot_name][server.id] = \
-                    {"CHANNELS": {}, "ROLES": {}}
-            self.perms_we_want[cmd_dot_name][server.id]["ROLES"][role.id] = \
-                "{}{}".format(allow, cmd_dot_name)
-            self.perm_lock.release()
-            self._save_perms()
+                chanid = target.strip("<#>")
+                channel = server.get_channel(chanid) or discord.utils.get(
+                    server.channels, name=target.lstrip("#"))
+                if channel is None:
+                    errors.append((lineno, "unknown channel "
+                                           "{}".format(target)))
+                    continue
+                target_id = channel.id
+                kind = "CHANNELS"
+            changes.append((kind, target_id, command, actions[action.lower()]))
+
+        if errors:
+            raise BulkError(errors)
+        return changes
+
+    async def _bulk_edit(self, server, changes):
+        """
+        Applies changes, a list of (kind, target id, command, allow) with
+            allow None for a reset, as one transaction: one lock, one
+            invalidation and one save. If any change fails the server's rules
+            are put back the way they were and the error is raised, nothing
+            else is touched until every change went through.
+        """
+        cmds = []
+        with (await self.server_locks[server.id]):
+            created = server.id not in self._shard_ids
+            shard = self._get_shard(server.id, create=True)
+            backup = (shard.commands.to_json(), shard.cogs.to_json())
+            try:
+                for kind, target_id, command, allow in changes:
+                    if allow is None:
+                        self._drop_rule(shard, command, kind, target_id)
+                    else:
+                        cmds.extend(self._put_rule(shard, command, kind,
+                                                   target_id, allow)[1])
+            except Exception:
+                if created:
+                    self.shards.pop(server.id, None)
+                    self._shard_ids.discard(server.id)
+                else:
+                    # The shard object stays, its writer snapshots it
+                    shard.commands = RuleSet(backup[0])
+                    shard.cogs = RuleSet(backup[1])
+                raise
+            for kind, target_id, command, allow in changes:
+                if allow is not None:
+                    self._note_rule(command)
+
+        for cmd in cmds:
+            self._install_check(cmd.qualified_name.replace(" ", "."), cmd)
+        self._invalidate(server)
+        self._save_shard(server.id)
 
     @commands.group(pass_context=True, no_pm=True)
     @checks.serverowner_or_permissions(manage_roles=True)
@@ -574,14 +1926,7 @@ class Permissions:
 
         Not really useful because role perm overrides channel perm"""
         server = ctx.message.server
-        try:
-            command_obj = self._get_command(command)
-        except BadCommand as e:
-            try:
-                self.bot.cogs[command]
-                command_obj = command
-            except KeyError:
-                raise e
+        command_obj = self._get_scope(command)
         if channel is None:
             channel = ctx.message.channel
         await self._set_permission(command_obj, server, channel=channel)
@@ -595,14 +1940,7 @@ class Permissions:
 
         Overridden by role based permissions"""
         server = ctx.message.server
-        try:
-            command_obj = self._get_command(command)
-        except BadCommand as e:
-            try:
-                self.bot.cogs[command]
-                command_obj = command
-            except KeyError:
-                raise e
+        command_obj = self._get_scope(command)
         if channel is None:
             channel = ctx.message.channel
         await self._set_permission(command_obj, server, channel=channel,
@@ -615,14 +1953,7 @@ class Permissions:
     async def channel_reset(self, ctx, command, channel: discord.Channel=None):
         """Resets permissions of [command/cog] on [channel] to the default"""
         server = ctx.message.server
-        try:
-            command_obj = self._get_command(command)
-        except BadCommand as e:
-            try:
-                self.bot.cogs[command]
-                command_obj = command
-            except KeyError:
-                raise e
+        command_obj = self._get_scope(command)
         if channel is None:
             channel = ctx.message.channel
         await self._reset_permission(command_obj, server, channel=channel)
@@ -631,20 +1962,37 @@ class Permissions:
             channel.mention, command))
 
     @p.command(pass_context=True)
-    async def info(self, ctx, command):
-        """Gives current info about permissions on your server"""
+    async def info(self, ctx, command=None):
+        """Gives current info about permissions on your server
+
+        Without a command, lists every rule and lock set on this server."""
         server = ctx.message.server
         channel = ctx.message.channel
-        if command not in self.perms_we_want:
+        if command is None:
+            await self._server_info(server)
+            return
+        if PatternTrie.is_pattern(command):
+            # Wildcards can't be locked
+            command = self._get_scope(command)
+            is_locked = False
+        else:
+            cmd_obj = self._get_command(command)
+            command = cmd_obj.qualified_name.replace(" ", ".")
+            # Locks are kept apart from rules, a locked command is still
+            #   worth showing even if it has no rules here.
+            is_locked = self._is_locked(command, server, channel,
+                                        cmd_obj.cog_name)
+        shard = self._get_shard(server.id)
+        if command not in self.commands_with_perms and not is_locked:
             await self.bot.say("No permissions have been set up for that"
                                " command")
             return
-        elif server.id not in self.perms_we_want[command]:
+        elif (shard is None or command not in shard.commands) and \
+                not is_locked:
             await self.bot.say("No permissions have been set up for this"
                                " server.")
             return
-        cmd_obj = self._get_command(command)
-        perm_info = await self._get_info(server, cmd_obj)
+        perm_info = await self._get_info(server, command)
         headers = ["Channel", "Status", "Role", "Status", "Locked Here"]
 
         partial = itertools.zip_longest(perm_info["CHANNELS"],
@@ -656,7 +2004,7 @@ class Permissions:
         data = []
         for i, row in enumerate(partial):
             if i == 0:
-                locked = (str(self._is_locked(command, server, channel)), )
+                locked = (str(is_locked), )
             else:
                 locked = tuple()
             data.append(row[0] + row[1] + locked)
@@ -664,6 +2012,17 @@ class Permissions:
         msg = tabulate(data, headers=headers, tablefmt='psql')
         await self.bot.say(box(msg))
 
+    async def _server_info(self, server):
+        rows = self._get_server_info(server)
+        if not rows:
+            await self.bot.say("No permissions have been set up for this"
+                               " server.")
+            return
+        headers = ["Type", "Name", "Command", "Status"]
+        msg = tabulate(rows, headers=headers, tablefmt='psql')
+        for page in pagify(msg, delims=["\n"], shorten_by=16):
+            await self.bot.say(box(page))
+
     @p.group(pass_context=True, invoke_without_command=True)
     async def lock(self, ctx, command):
         """Globally locks a command from being used by anyone but owner
@@ -732,6 +2091,186 @@ class Permissions:
 
         await self.bot.say("Permissions reset.")
 
+    @p.command(pass_context=True, name="bulk")
+    async def p_bulk(self, ctx, *, script=None):
+        """Sets or resets many channel/role rules at once
+
+        One rule per line, after the command or in an attached text file:
+            role allow playlist.* DJ
+            role deny Audio everyone
+            channel reset play #music
+        Nothing is changed unless every line is valid."""
+        server = ctx.message.server
+        if script is None:
+            if not ctx.message.attachments:
+                await send_cmd_help(ctx)
+                return
+            url = ctx.message.attachments[0]["url"]
+            script = await self._fetch_attachment(url)
+            if script is None:
+                await self.bot.say("Couldn't read the attached file.")
+                return
+
+        try:
+            changes = self._parse_bulk(server, script)
+        except BulkError as e:
+            msg = "\n".join("Line {}: {}".format(lineno, reason)
+                            for lineno, reason in e.errors)
+            for page in pagify(msg, delims=["\n"], shorten_by=16):
+                await self.bot.say(box(page))
+            await self.bot.say("Nothing was changed.")
+            return
+        if not changes:
+            await send_cmd_help(ctx)
+            return
+
+        await self._bulk_edit(server, changes)
+        await self.bot.say("Applied {} rules.".format(len(changes)))
+
+    async def _fetch_attachment(self, url):
+        try:
+            with aiohttp.ClientSession() as session:
+                with aiohttp.Timeout(10):
+                    async with session.get(url) as r:
+                        return await r.text()
+        except Exception:
+            return None
+
+    @p.command(pass_context=True, name="gc")
+    async def p_gc(self, ctx, mode=None):
+        """Prunes permissions of deleted roles, channels and left servers
+
+        `p gc full` also prunes those of commands and cogs that aren't loaded
+        right now, make sure every cog you use is loaded first."""
+        author = ctx.message.author
+        if author.id != self.bot.settings.owner:
+            return
+
+        await self.bot.say("Collecting garbage, this can take a while.")
+        full = mode is not None and mode.lower() == "full"
+        stats = await self._collect_garbage(load=True, commands=full,
+                                            drop_servers=True)
+        if not stats:
+            await self.bot.say("Nothing to prune.")
+            return
+        data = sorted(stats.items())
+        msg = tabulate(data, headers=["Pruned", "Count"], tablefmt='psql')
+        await self.bot.say(box(msg))
+
+    @p.command(pass_context=True, name="cache", hidden=True)
+    async def p_cache(self, ctx):
+        """Shows permission decision cache statistics"""
+        cache = self.decision_cache
+        total = cache.hits + cache.misses
+        ratio = cache.hits / total if total else 0
+        data = [("Entries", cache.size), ("Hits", cache.hits),
+                ("Misses", cache.misses),
+                ("Hit ratio", "{:.1%}".format(ratio))]
+        msg = tabulate(data, tablefmt='psql')
+        await self.bot.say(box(msg))
+
+    @p.command(pass_context=True, name="storage", hidden=True)
+    async def p_storage(self, ctx):
+        """Shows pending changes and save latency of the permission files"""
+        writers = [self._global_writer] + sorted(
+            self._shard_writers.values(), key=lambda w: w.pending,
+            reverse=True)[:10]
+        data = []
+        for writer in writers:
+            data.append((os.path.basename(writer.path), writer.pending,
+                         writer.writes,
+                         "{:.1f}".format(writer.last_latency * 1000),
+                         "{:.1f}".format(writer.avg_latency * 1000)))
+        headers = ["File", "Pending", "Writes", "Last (ms)", "Avg (ms)"]
+        msg = tabulate(data, headers=headers, tablefmt='psql')
+        msg += "\n{} of {} server shards loaded".format(
+            len(self.shards), len(self._shard_ids))
+        await self.bot.say(box(msg))
+
+    @p.command(pass_context=True, name="stats")
+    async def p_stats(self, ctx, mode=None):
+        """Shows which commands are checked most and what checks cost
+
+        `p stats on` and `p stats off` start and stop collecting, `p stats
+        reset` clears the numbers and `p stats dump` writes all of them to
+        data/permissions/stats.json"""
+        author = ctx.message.author
+        if author.id != self.bot.settings.owner:
+            return
+
+        mode = mode.lower() if mode is not None else None
+        if mode in ("on", "off"):
+            self.stats.enabled = mode == "on"
+            self._save_global()
+            await self.bot.say("Permission stats turned {}.".format(mode))
+            return
+        elif mode == "reset":
+            self.stats.reset()
+            await self.bot.say("Permission stats reset.")
+            return
+        elif mode == "dump":
+            data = self._stats_snapshot()
+            await self.bot.loop.run_in_executor(None, dataIO.save_json,
+                                                STATS_PATH, data)
+            await self.bot.say("Permission stats written to {}".format(
+                STATS_PATH))
+            return
+        elif mode is not None:
+            await send_cmd_help(ctx)
+            return
+
+        if not self.stats.enabled and not self.stats.commands:
+            await self.bot.say("Permission stats are off, turn them on with"
+                               " `p stats on`.")
+            return
+        await self._say_stats()
+
+    async def _say_stats(self):
+        stats = self.stats
+
+        def rows(table, name):
+            for key, (count, denied, hist) in stats.top(table):
+                p50 = stats.percentile(hist, 0.5)
+                p99 = stats.percentile(hist, 0.99)
+                yield (name(key), count, denied,
+                       "<{}".format(p50) if p50 is not None else "slower",
+                       "<{}".format(p99) if p99 is not None else "slower")
+
+        def server_name(server_id):
+            server = self._get_server_from_id(server_id)
+            return server.name if server is not None else server_id
+
+        headers = ["Checks", "Denied", "p50 (us)", "p99 (us)"]
+        cache = self.decision_cache
+        msg = "Collecting: {}, since {}\n".format(
+            stats.enabled, time.strftime("%Y-%m-%d %H:%M:%S",
+                                         time.localtime(stats.since)))
+        msg += "Decision cache: {} hits, {} misses, {} owner overrides\n\n"\
+            .format(cache.hits, cache.misses, stats.overrides)
+        msg += tabulate(list(rows(stats.commands, str)), tablefmt='psql',
+                        headers=["Command"] + headers)
+        msg += "\n\n"
+        msg += tabulate(list(rows(stats.servers, server_name)),
+                        tablefmt='psql', headers=["Server"] + headers)
+        for page in pagify(msg, delims=["\n\n", "\n"], shorten_by=16):
+            await self.bot.say(box(page))
+
+    def _stats_snapshot(self):
+        data = self.stats.to_json()
+        cache = self.decision_cache
+        data["cache"] = {"entries": cache.size, "hits": cache.hits,
+                         "misses": cache.misses}
+        writers = [self._global_writer] + list(self._shard_writers.values())
+        writes = sum(w.writes for w in writers)
+        data["storage"] = {
+            "writes": writes,
+            "pending": sum(w.pending for w in writers),
+            "avg_latency": sum(w.total_latency for w in writers) / writes
+            if writes else 0,
+            "shards_loaded": len(self.shards),
+            "shards": len(self._shard_ids)}
+        return data
+
     @p.group(pass_context=True)
     async def role(self, ctx):
         """Role based permissions
@@ -747,14 +2286,7 @@ class Permissions:
 
         This OVERRIDES channel based permissions"""
         server = ctx.message.server
-        try:
-            command_obj = self._get_command(command)
-        except BadCommand as e:
-            try:
-                self.bot.cogs[command]
-                command_obj = command
-            except KeyError:
-                raise e
+        command_obj = self._get_scope(command)
         role = self._get_role(server.roles, role)
         await self._set_permission(command_obj, server, role=role)
 
@@ -767,14 +2299,7 @@ class Permissions:
 
         This OVERRIDES channel based permissions"""
         server = ctx.message.server
-        try:
-            command_obj = self._get_command(command)
-        except BadCommand as e:
-            try:
-                self.bot.cogs[command]
-                command_obj = command
-            except KeyError:
-                raise e
+        command_obj = self._get_scope(command)
         role = self._get_role(server.roles, role)
         await self._set_permission(command_obj, server, role=role, allow=False)
 
@@ -785,14 +2310,7 @@ class Permissions:
     async def role_reset(self, ctx, command, *, role):
         """Reset permissions of [role] on [command/cog] to the default"""
         server = ctx.message.server
-        try:
-            command_obj = self._get_command(command)
-        except BadCommand as e:
-            try:
-                self.bot.cogs[command]
-                command_obj = command
-            except KeyError:
-                raise e
+        command_obj = self._get_scope(command)
         role = self._get_role(server.roles, role)
         await self._reset_permission(command_obj, server, role=role)
 
@@ -860,27 +2378,58 @@ class Permissions:
         if cmd and cmd.qualified_name.split(" ")[0] == "p":
             await self._error_responses(error, ctx)
 
-    async def add_checks_to_all(self):
-        while self == self.bot.get_cog('Permissions'):
-            perms_we_want = copy.copy(self.perms_we_want)
-            for cmd_dot in perms_we_want:
-                try:
-                    cmd_obj = self._get_command(cmd_dot)
-                    check_obj = discord.utils.find(
-                        lambda c: type(c).__name__ == "Check", cmd_obj.checks)
-                except BadCommand:
-                    # Command is no longer loaded/found
-                    pass
-                except AttributeError:
-                    # cmd_obj got to be None somehow so we'll assume it's not
-                    #   loaded
-                    pass
-                else:
-                    if check_obj is None:
-                        log.debug("Check object not found in {},"
-                                  " adding".format(cmd_dot))
-                        cmd_obj.checks.append(Check(cmd_dot))
-            await asyncio.sleep(0.5)
+    def _rebuild_hierarchy(self, server):
+        self.role_index[server.id] = RoleHierarchy(server.roles)
+        # Bits are assigned by rank so every compiled table is stale
+        self._invalidate(server)
+
+    async def on_server_role_create(self, role):
+        self._rebuild_hierarchy(role.server)
+
+    async def on_server_role_delete(self, role):
+        self._prune_target(role.server, "ROLES", role.id)
+        self._rebuild_hierarchy(role.server)
+
+    async def on_server_role_update(self, before, after):
+        # Roles are updated in place so renames and the like are already
+        #   reflected, only a move changes the hierarchy.
+        if before.position != after.position:
+            self._rebuild_hierarchy(after.server)
+
+    async def on_channel_update(self, *args):
+        channel = args[0]
+        if not channel.is_private:
+            self._invalidate(channel.server)
+
+    async def on_channel_delete(self, channel):
+        if channel.is_private:
+            return
+        self._prune_target(channel.server, "CHANNELS", channel.id)
+        shard = self.shards.get(channel.server.id)
+        if shard is not None and \
+                shard.channel_locks.pop(channel.id, None) is not None:
+            self._save_shard(channel.server.id)
+        self._invalidate(channel.server)
+
+    def _prune_target(self, server, kind, target_id):
+        """
+        Drops the rules of a deleted role or channel, only if the shard is
+            loaded, otherwise it is compacted when it is.
+        """
+        shard = self.shards.get(server.id)
+        if shard is None:
+            return
+        removed = shard.commands.remove_target(kind, target_id)
+        removed |= shard.cogs.remove_target(kind, target_id)
+        if removed:
+            self._save_shard(server.id)
+
+    async def on_server_remove(self, server):
+        self.role_index.pop(server.id, None)
+        lock = self.server_locks.get(server.id)
+        if lock is not None and not lock.locked():
+            del self.server_locks[server.id]
+        self._invalidate(server)
 
 
 def setup(bot):
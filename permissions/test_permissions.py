@@ -0,0 +1,525 @@
+"""
+Tests for the Permissions cog. Nothing connects to Discord.
+
+Run them from the root of a Red install (cogs.utils has to be importable)
+    with discord.py, tabulate and pytest installed:
+
+    python -m pytest path/to/permissions/test_permissions.py
+"""
+
+import asyncio
+import copy
+import inspect
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+pytest.importorskip("discord")
+pytest.importorskip("cogs.utils.dataIO")
+pytest.importorskip("tabulate")
+
+from discord.ext import commands
+
+import __main__
+
+
+class Settings:
+    owner = "owner"
+
+
+async def send_cmd_help(ctx):
+    pass
+
+
+# permissions.py does `from __main__ import send_cmd_help, settings`
+__main__.settings = Settings()
+__main__.send_cmd_help = send_cmd_help
+
+import permissions
+
+
+class FakeRole:
+    def __init__(self, id, position, server):
+        self.id = id
+        self.name = "role{}".format(id)
+        self.position = position
+        self.server = server
+
+
+class FakeChannel:
+    def __init__(self, id, server):
+        self.id = id
+        self.name = "chan{}".format(id)
+        self.server = server
+        self.is_private = False
+
+
+class FakeServer:
+    def __init__(self, id, roles=5, channels=3):
+        self.id = id
+        self.name = "server{}".format(id)
+        self.unavailable = False
+        self.roles = [FakeRole("{}.{}".format(id, i), i, self)
+                      for i in range(roles)]
+        self.channels = [FakeChannel("{}.c{}".format(id, i), self)
+                         for i in range(channels)]
+
+    def get_channel(self, channel_id):
+        for channel in self.channels:
+            if channel.id == channel_id:
+                return channel
+
+
+class FakeMember:
+    def __init__(self, id, server, roles):
+        self.id = id
+        self.name = "member{}".format(id)
+        self.server = server
+        # @everyone first, like discord.py
+        self.roles = [server.roles[0]] + roles
+
+
+class FakeBot:
+    """
+    Just what the cog uses, add_cog and remove_cog register commands and
+        on_ listeners the way discord.ext.commands.Bot does.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.commands = {}
+        self.cogs = {}
+        self.servers = []
+        self.listeners = {}
+
+    def add_command(self, command):
+        self.commands[command.name] = command
+
+    def remove_command(self, name):
+        return self.commands.pop(name, None)
+
+    def add_cog(self, cog):
+        self.cogs[type(cog).__name__] = cog
+        for name, member in inspect.getmembers(cog):
+            if isinstance(member, commands.Command):
+                if member.parent is None:
+                    self.add_command(member)
+            elif name.startswith("on_"):
+                self.listeners.setdefault(name, []).append(member)
+
+    def remove_cog(self, name):
+        cog = self.cogs.pop(name)
+        for attr, member in inspect.getmembers(cog):
+            if isinstance(member, commands.Command):
+                if member.parent is None:
+                    self.remove_command(member.name)
+            elif attr.startswith("on_"):
+                self.listeners[attr].remove(member)
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    def get_channel(self, channel_id):
+        for server in self.servers:
+            for channel in server.channels:
+                if channel.id == channel_id:
+                    return channel
+
+    async def wait_until_ready(self):
+        pass
+
+
+class Audio:
+    @commands.command(pass_context=True)
+    async def play(self, ctx):
+        pass
+
+    @commands.command(pass_context=True)
+    async def stop(self, ctx):
+        pass
+
+    @commands.group(pass_context=True)
+    async def playlist(self, ctx):
+        pass
+
+    @playlist.group(pass_context=True, name="queue")
+    async def playlist_queue(self, ctx):
+        pass
+
+    @playlist_queue.command(pass_context=True, name="clear")
+    async def playlist_queue_clear(self, ctx):
+        pass
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def bot(tmpdir, monkeypatch, loop):
+    monkeypatch.chdir(str(tmpdir))
+    tmpdir.mkdir("data")
+    bot = FakeBot(loop)
+    bot.servers.append(FakeServer("1"))
+    bot.add_cog(Audio())
+    return bot
+
+
+@pytest.fixture
+def perm(bot, loop):
+    perm = permissions.Permissions(bot)
+    bot.add_cog(perm)
+    yield perm
+    perm._Permissions__unload()
+    loop.run_until_complete(asyncio.sleep(0))
+
+
+def allowed(perm, command, member, channel):
+    ctx = types.SimpleNamespace(
+        command=command,
+        message=types.SimpleNamespace(server=channel.server, channel=channel,
+                                      author=member))
+    return perm.resolve_permission(ctx)
+
+
+def test_decision_cache():
+    cache = permissions.DecisionCache(max_size=3)
+    roles = frozenset(["r"])
+    assert cache.get("play", "1", "c", roles) is None
+    cache.put("play", "1", "c", roles, False)
+    cache.put("stop", "1", "c", roles, True)
+    cache.put("play", "2", "c", roles, True)
+    assert cache.get("play", "1", "c", roles) is False
+    assert (cache.hits, cache.misses, cache.size) == (1, 1, 3)
+
+    cache.invalidate("1", "play")
+    assert cache.get("play", "1", "c", roles) is None
+    assert cache.get("stop", "1", "c", roles) is True
+    cache.invalidate(command="play")
+    assert cache.get("play", "2", "c", roles) is None
+    cache.invalidate("1")
+    assert cache.get("stop", "1", "c", roles) is None
+    assert cache.size == 0
+
+    # Full, starts over rather than growing
+    for i in range(4):
+        cache.put("cmd{}".format(i), "1", "c", roles, True)
+    assert cache.size == 1
+
+
+def test_compile_then_resolve(bot, perm, loop):
+    server = bot.servers[0]
+    r = server.roles
+    play = bot.commands["play"]
+    loop.run_until_complete(perm._set_role(play, server, r[1], False))
+    loop.run_until_complete(perm._set_role(play, server, r[3], True))
+    loop.run_until_complete(perm._set_channel(play, server,
+                                              server.channels[1], False))
+
+    chan = server.channels[0]
+    # The highest role with a rule wins, whatever order the member has them
+    assert not allowed(perm, play, FakeMember("a", server, [r[1]]), chan)
+    assert allowed(perm, play, FakeMember("b", server, [r[3], r[1]]), chan)
+    assert allowed(perm, play, FakeMember("c", server, [r[1], r[3]]), chan)
+    # Without a role rule the channel rule decides
+    assert allowed(perm, play, FakeMember("d", server, [r[2]]), chan)
+    assert not allowed(perm, play, FakeMember("d", server, [r[2]]),
+                       server.channels[1])
+    # A role rule beats the channel rule
+    assert allowed(perm, play, FakeMember("b", server, [r[3]]),
+                   server.channels[1])
+    assert allowed(perm, bot.commands["stop"],
+                   FakeMember("a", server, [r[1]]), chan)
+
+    compiled = perm.compiled[server.id]
+    table, = compiled.tables["play"]
+    assert table.allow == compiled.role_bits[r[3].id]
+    assert table.deny == compiled.role_bits[r[1].id]
+    assert table.channels == {server.channels[1].id: False}
+    assert compiled.tables["stop"] == ()
+
+
+def test_cache_hits_until_rule_changes(bot, perm, loop):
+    server = bot.servers[0]
+    play = bot.commands["play"]
+    member = FakeMember("a", server, [server.roles[1]])
+    chan = server.channels[0]
+
+    assert allowed(perm, play, member, chan)
+    assert allowed(perm, play, member, chan)
+    assert perm.decision_cache.hits == 1
+
+    loop.run_until_complete(perm._set_role(play, server, server.roles[1],
+                                           False))
+    assert "play" not in perm.compiled[server.id].tables
+    assert not allowed(perm, play, member, chan)
+    loop.run_until_complete(perm._reset_role(play, server, server.roles[1]))
+    assert allowed(perm, play, member, chan)
+
+    # Cog rules drop the whole server's tables
+    loop.run_until_complete(perm._set_role("Audio", server, server.roles[1],
+                                           False))
+    assert not allowed(perm, play, member, chan)
+    assert not allowed(perm, bot.commands["stop"], member, chan)
+
+
+def test_invalidated_on_role_move(bot, perm, loop):
+    server = bot.servers[0]
+    r = server.roles
+    play = bot.commands["play"]
+    loop.run_until_complete(perm._set_role(play, server, r[1], False))
+    loop.run_until_complete(perm._set_role(play, server, r[2], True))
+    member = FakeMember("a", server, [r[1], r[2]])
+    chan = server.channels[0]
+    assert allowed(perm, play, member, chan)
+
+    # Roles are updated in place, before is a copy with the old position
+    before = copy.copy(r[1])
+    r[1].position, r[2].position = 2, 1
+    for listener in bot.listeners["on_server_role_update"]:
+        loop.run_until_complete(listener(before, r[1]))
+    assert not allowed(perm, play, member, chan)
+
+
+def test_invalidated_on_role_and_channel_delete(bot, perm, loop):
+    server = bot.servers[0]
+    r = server.roles
+    play = bot.commands["play"]
+    gone = server.channels[1]
+    loop.run_until_complete(perm._set_role(play, server, r[2], False))
+    loop.run_until_complete(perm._set_channel(play, server, gone, False))
+    member = FakeMember("a", server, [r[1], r[2]])
+    assert not allowed(perm, play, member, server.channels[0])
+    assert not allowed(perm, play, FakeMember("b", server, []), gone)
+
+    role = r[2]
+    server.roles.remove(role)
+    for listener in bot.listeners["on_server_role_delete"]:
+        loop.run_until_complete(listener(role))
+    assert allowed(perm, play, member, server.channels[0])
+    assert perm.shards[server.id].commands.targets == {
+        ("CHANNELS", gone.id): {"play"}}
+
+    server.channels.remove(gone)
+    for listener in bot.listeners["on_channel_delete"]:
+        loop.run_until_complete(listener(gone))
+    assert allowed(perm, play, FakeMember("b", server, []), gone)
+    assert perm.shards[server.id].commands.targets == {}
+
+
+def test_listeners_follow_the_cog(bot, perm, loop):
+    bot.remove_cog("Permissions")
+    assert not any(bot.listeners.values())
+    fresh = permissions.Permissions(bot)
+    bot.add_cog(fresh)
+    try:
+        assert all(listener.__self__ is fresh
+                   for listeners in bot.listeners.values()
+                   for listener in listeners)
+    finally:
+        fresh._Permissions__unload()
+
+
+def test_rules_are_interned():
+    # Built at runtime so only interning can make them the same object
+    role_id = "".join(["12", "34"])
+    first = permissions.RuleSet({"play": {"ROLES": {role_id: "-play"}}})
+    second = permissions.RuleSet({"stop": {"ROLES": {"".join(["1", "234"]):
+                                                     True}}})
+    second.set_rule("".join(["pl", "ay"]), "ROLES", "".join(["123", "4"]),
+                    True)
+
+    first_id, = first.get("play").roles
+    second_ids = {target_id for scope in ("play", "stop")
+                  for target_id in second.get(scope).roles}
+    assert all(target_id is first_id for target_id in second_ids)
+    assert next(iter(first.rules)) is next(k for k in second.rules
+                                           if k == "play")
+    # Old "+"/"-" strings load as booleans
+    assert first.get("play").to_json() == {"CHANNELS": {},
+                                           "ROLES": {"1234": False}}
+
+
+def test_remove_scope_prunes():
+    rules = permissions.RuleSet()
+    rules.set_rule("play", "ROLES", "r1", False)
+    rules.set_rule("play", "CHANNELS", "c1", True)
+    rules.set_rule("stop", "ROLES", "r1", True)
+    rules.set_rule("playlist.queue.*", "ROLES", "r1", True)
+
+    assert rules.remove_scope("play") == 2
+    assert "play" not in rules
+    assert rules.targets == {("ROLES", "r1"): {"stop", "playlist.queue.*"}}
+
+    assert rules.remove_scope("playlist.queue.*") == 1
+    # The trie branch that only led to the pattern goes too
+    assert rules.patterns.children == {}
+    assert rules.patterns.matches("playlist.queue.clear") == []
+    assert rules.remove_scope("nothing") == 0
+
+    rules.set_rule("skip", "ROLES", "r2", True)
+    rules.remove_rule("skip", "ROLES", "r2")
+    assert rules.remove_empty() == 1
+    assert set(rules.rules) == {"stop"}
+    assert rules.targets == {("ROLES", "r1"): {"stop"}}
+
+
+def test_pattern_trie_order():
+    trie = permissions.PatternTrie()
+    for pattern in ("*", "playlist.*", "playlist.queue.*", "play.*"):
+        trie.add(pattern)
+    assert trie.matches("playlist.queue.clear") == ["playlist.queue.*",
+                                                    "playlist.*", "*"]
+    assert trie.matches("playlist.queue") == ["playlist.*", "*"]
+    assert trie.matches("play") == ["*"]
+
+    trie.remove("playlist.*")
+    assert trie.matches("playlist.queue.clear") == ["playlist.queue.*", "*"]
+
+
+def test_wildcard_resolution_order(bot, perm, loop):
+    server = bot.servers[0]
+    role = server.roles[1]
+    member = FakeMember("a", server, [role])
+    chan = server.channels[0]
+    clear = bot.commands["playlist"].commands["queue"].commands["clear"]
+
+    # Each layer set contradicts the one below it. The cog rule goes first,
+    #   setting one drops the command rules of the cog for the same role.
+    scopes = [(clear, True), ("playlist.queue.*", False),
+              ("playlist.*", True), ("*", False), ("Audio", True)]
+    for scope, allow in reversed(scopes):
+        loop.run_until_complete(perm._set_role(scope, server, role, allow))
+
+    for scope, allow in scopes:
+        assert allowed(perm, clear, member, chan) is allow
+        loop.run_until_complete(perm._reset_role(scope, server, role))
+    assert allowed(perm, clear, member, chan)
+
+
+def test_scope_patterns(bot, perm):
+    assert perm._get_scope("*") == "*"
+    assert perm._get_scope("playlist.queue.*") == "playlist.queue.*"
+    for bad in (".*", "nope.*", "playlist..*"):
+        with pytest.raises(permissions.BadCommand):
+            perm._get_scope(bad)
+
+
+def test_info_skips_deleted_roles(bot, perm, loop):
+    server = bot.servers[0]
+    r = server.roles
+    play = bot.commands["play"]
+    loop.run_until_complete(perm._set_role(play, server, r[1], False))
+    loop.run_until_complete(perm._set_role(play, server, r[2], True))
+    # Gone without the delete event pruning its rules
+    server.roles.remove(r[2])
+
+    info = loop.run_until_complete(perm._get_info(server, "play"))
+    assert info == {"CHANNELS": [], "ROLES": [(r[1].name, "Denied")]}
+    with pytest.raises(permissions.RoleNotFound):
+        perm._get_role(server.roles, "nope")
+
+
+def test_parse_bulk(bot, perm):
+    server = bot.servers[0]
+    r, c = server.roles, server.channels
+    script = """```
+# comment
+role allow play role1.1
+channel deny playlist.* <#1.c0>
+role reset Audio role1.2
+```"""
+    assert perm._parse_bulk(server, script) == [
+        ("ROLES", r[1].id, bot.commands["play"], True),
+        ("CHANNELS", c[0].id, "playlist.*", False),
+        ("ROLES", r[2].id, "Audio", None)]
+
+    script = """role allow play role1.1
+role maybe play role1.1
+role allow nope role1.1
+role allow play nobody
+channel deny play #nowhere"""
+    with pytest.raises(permissions.BulkError) as e:
+        perm._parse_bulk(server, script)
+    assert [n for n, reason in e.value.errors] == [2, 3, 4, 5]
+    assert e.value.errors[2] == (4, "unknown role nobody")
+
+
+def test_bulk_edit(bot, perm, loop):
+    server = bot.servers[0]
+    r = server.roles
+    play = bot.commands["play"]
+    member = FakeMember("a", server, [r[1]])
+    chan = server.channels[0]
+    loop.run_until_complete(perm._set_role(play, server, r[1], False))
+
+    changes = [("ROLES", r[1].id, play, None),
+               ("ROLES", r[1].id, "Audio", False)]
+    loop.run_until_complete(perm._bulk_edit(server, changes))
+    assert not allowed(perm, bot.commands["stop"], member, chan)
+    assert "Audio" in perm.cogs_with_perms
+
+
+def test_bulk_edit_rolls_back(bot, perm, loop, monkeypatch):
+    server = bot.servers[0]
+    r = server.roles
+    play = bot.commands["play"]
+    member = FakeMember("a", server, [r[1]])
+    chan = server.channels[0]
+    put_rule = perm._put_rule
+
+    def failing_put_rule(shard, command, *args):
+        if command == "Audio":
+            raise RuntimeError("boom")
+        return put_rule(shard, command, *args)
+
+    monkeypatch.setattr(perm, "_put_rule", failing_put_rule)
+    changes = [("ROLES", r[1].id, "playlist.*", False),
+               ("ROLES", r[1].id, "Audio", False)]
+
+    # A server without rules gets nothing, not even an empty shard
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(perm._bulk_edit(server, changes))
+    assert server.id not in perm.shards
+    assert server.id not in perm._shard_ids
+    assert not perm.commands_with_perms and not perm.cogs_with_perms
+
+    loop.run_until_complete(perm._set_role(play, server, r[1], False))
+    changes.insert(0, ("ROLES", r[1].id, play, None))
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(perm._bulk_edit(server, changes))
+    assert not allowed(perm, play, member, chan)
+    assert perm.commands_with_perms == {"play"}
+    assert not perm.cogs_with_perms
+
+
+def test_gc_evicts_without_blocking(bot, perm, loop, monkeypatch):
+    server = bot.servers[0]
+    r = server.roles
+    play = bot.commands["play"]
+    loop.run_until_complete(perm._set_role(play, server, r[1], False))
+    loop.run_until_complete(perm._set_role(play, server, r[2], False))
+    loop.run_until_complete(perm._evict_shard(server.id))
+    assert server.id not in perm.shards
+
+    def flush(self):
+        raise AssertionError("wrote on the event loop")
+
+    server.roles.remove(r[2])
+    with monkeypatch.context() as m:
+        m.setattr(permissions.WriteBehind, "flush", flush)
+        stats = loop.run_until_complete(perm._collect_garbage(load=True))
+    assert stats["roles"] == 1
+    assert server.id not in perm.shards
+    assert server.id not in perm._shard_writers
+    # What gc compacted made it to disk before the shard was let go
+    shard = perm._get_shard(server.id)
+    assert shard.commands.targets == {("ROLES", r[1].id): {"play"}}
@@ -7,13 +7,23 @@ from cogs.utils.chat_formatting import *
 import logging
 import os
 import asyncio
+import copy
+import datetime
+import heapq
+import itertools
+import json
+import tempfile
+import threading
 import time
-from random import randint
-from math import ceil
+from random import randint, uniform
+from math import ceil, floor
 
 log = logging.getLogger("red.scheduler")
 log.setLevel(logging.INFO)
 
+EVENTS_PATH = 'data/scheduler/events.json'
+JOURNAL_PATH = 'data/scheduler/events.journal'
+
 
 class Event:
     def __init__(self, data=None):
@@ -25,13 +35,499 @@ class Event:
         self.timedelta = data.pop('timedelta')
         self.repeat = data.pop('repeat')
         self.starttime = data.pop('starttime', None)
+        self.lastrun = data.pop('lastrun', None)
+        # What to do about runs missed while the bot was down: skip, once or
+        #   all, None for the default in settings.json
+        self.catchup = data.pop('catchup', None)
+        # Set while missed runs are being made up for
+        self.catching_up = False
+        # Fake message this event runs as, built on its first run
+        self.message = None
+
+    @property
+    def key(self):
+        return (self.server, self.name)
+
+
+class EventQueue:
+    """
+    Min-heap of [time, seq, event] entries plus an index by (server, name).
+        seq is a running counter so events due at the same time keep the
+        order they were queued in and events themselves are never compared.
+
+    Removing or rescheduling an event only marks its old entry dead (event
+        set to None), dead entries are skipped when they reach the top and
+        the heap is rebuilt once they make up most of it.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._index = {}
+        self._seq = itertools.count()
+        self._dead = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def push(self, when, event):
+        """
+        Queues event at when, replacing its earlier entry if it had one.
+        """
+        self._kill(self._index.pop(event.key, None))
+        entry = [when, next(self._seq), event]
+        self._index[event.key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, server, name):
+        entry = self._index.pop((server, name), None)
+        self._kill(entry)
+        return entry is not None
+
+    def find(self, server, name):
+        entry = self._index.get((server, name))
+        return entry[2] if entry is not None else None
+
+    def peek(self):
+        """
+        (time, event) of the earliest event, None if there are none.
+        """
+        self._prune()
+        if not self._heap:
+            return None
+        when, _, event = self._heap[0]
+        return when, event
+
+    def pop(self):
+        self._prune()
+        when, _, event = heapq.heappop(self._heap)
+        del self._index[event.key]
+        return when, event
+
+    def pop_due(self, now):
+        """
+        Takes every event due at now out of the queue, in the order they're
+            due.
+        """
+        due = []
+        while True:
+            head = self.peek()
+            if head is None or head[0] > now:
+                return due
+            due.append(self.pop())
+
+    def next_time(self):
+        head = self.peek()
+        return head[0] if head is not None else None
+
+    def items(self):
+        return [(entry[0], entry[2]) for entry in self._index.values()]
+
+    def load(self, items):
+        """
+        Replaces the queue with items, (time, event) pairs, in one heapify.
+        """
+        self.clear()
+        for when, event in items:
+            entry = [when, next(self._seq), event]
+            self._index[event.key] = entry
+            self._heap.append(entry)
+        heapq.heapify(self._heap)
+
+    def clear(self):
+        self._heap = []
+        self._index = {}
+        self._dead = 0
+
+    def _kill(self, entry):
+        if entry is None:
+            return
+        entry[2] = None
+        self._dead += 1
+        if self._dead > 64 and self._dead * 2 > len(self._heap):
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapq.heapify(self._heap)
+            self._dead = 0
+
+    def _prune(self):
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+            self._dead -= 1
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel with the same interface as EventQueue, for
+        when there are very many events. Events sit in a second, minute,
+        hour or day bucket depending on how far out they are and move down a
+        wheel when their bucket's time comes, so queueing, removing and
+        firing cost the same however many events there are.
+
+    Each wheel keeps a small heap of its non-empty bucket numbers to find
+        the next one without walking empty slots. A bucket emptied by
+        remove keeps its number there until it comes up, so the numbers in
+        the heap are tracked to never add one twice.
+    """
+    # (seconds per bucket, how far out an event may be to go in this wheel)
+    WHEELS = ((1, 60), (60, 3600), (3600, 86400), (86400, None))
+
+    def __init__(self, now=None):
+        self._now = time.time() if now is None else now
+        self._seq = itertools.count()
+        self.clear()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def clear(self):
+        # wheel -> bucket number -> key -> [time, seq, event, wheel, bucket]
+        self._buckets = [{} for _ in self.WHEELS]
+        self._pending = [[] for _ in self.WHEELS]
+        # The bucket numbers in each _pending heap
+        self._queued = [set() for _ in self.WHEELS]
+        self._index = {}
+
+    def push(self, when, event, seq=None):
+        self.remove(*event.key)
+        if seq is None:
+            seq = next(self._seq)
+        delta = when - self._now
+        for wheel, (size, reach) in enumerate(self.WHEELS):
+            if reach is None or delta < reach:
+                break
+        bucket = int(when // size)
+        entry = [when, seq, event, wheel, bucket]
+        self._index[event.key] = entry
+        buckets = self._buckets[wheel]
+        if bucket not in buckets:
+            buckets[bucket] = {}
+            if bucket not in self._queued[wheel]:
+                self._queued[wheel].add(bucket)
+                heapq.heappush(self._pending[wheel], bucket)
+        buckets[bucket][event.key] = entry
+
+    def remove(self, server, name):
+        entry = self._index.pop((server, name), None)
+        if entry is None:
+            return False
+        buckets = self._buckets[entry[3]]
+        bucket = buckets[entry[4]]
+        del bucket[(server, name)]
+        if not bucket:
+            # Its number stays in the pending heap and is skipped there
+            del buckets[entry[4]]
+        return True
+
+    def find(self, server, name):
+        entry = self._index.get((server, name))
+        return entry[2] if entry is not None else None
+
+    def _next_bucket(self, wheel):
+        pending = self._pending[wheel]
+        buckets = self._buckets[wheel]
+        while pending and pending[0] not in buckets:
+            self._queued[wheel].discard(heapq.heappop(pending))
+        return pending[0] if pending else None
+
+    def _drop_bucket(self, wheel):
+        """
+        Takes the next bucket of wheel out of it, returns its entries.
+        """
+        bucket = heapq.heappop(self._pending[wheel])
+        self._queued[wheel].discard(bucket)
+        return self._buckets[wheel].pop(bucket)
+
+    def pop_due(self, now):
+        self._now = now
+        # Bring down every coarse bucket whose time has started, top first so
+        #   an hour that cascades into a due minute is handled in this pass.
+        for wheel in range(len(self.WHEELS) - 1, 0, -1):
+            size = self.WHEELS[wheel][0]
+            while True:
+                bucket = self._next_bucket(wheel)
+                if bucket is None or bucket * size > now:
+                    break
+                for entry in list(self._drop_bucket(wheel).values()):
+                    del self._index[entry[2].key]
+                    self.push(entry[0], entry[2], entry[1])
+
+        due = []
+        while True:
+            bucket = self._next_bucket(0)
+            if bucket is None or bucket > now:
+                break
+            entries = self._buckets[0][bucket]
+            for key, entry in list(entries.items()):
+                if entry[0] <= now:
+                    del entries[key]
+                    del self._index[key]
+                    due.append(entry)
+            if entries:
+                # The rest of this second isn't due yet
+                break
+            self._drop_bucket(0)
+        due.sort(key=lambda entry: (entry[0], entry[1]))
+        return [(entry[0], entry[2]) for entry in due]
+
+    def next_time(self):
+        """
+        When pop_due next has something to do. Exact for events in the second
+            wheel, the start of the bucket for the others.
+        """
+        times = []
+        for wheel, (size, _) in enumerate(self.WHEELS):
+            bucket = self._next_bucket(wheel)
+            if bucket is None:
+                continue
+            if wheel == 0:
+                times.append(min(entry[0] for entry in
+                                 self._buckets[0][bucket].values()))
+            else:
+                times.append(bucket * size)
+        return min(times) if times else None
+
+    def items(self):
+        return [(entry[0], entry[2]) for entry in self._index.values()]
+
+    def load(self, items):
+        self.clear()
+        for when, event in items:
+            self.push(when, event)
+
+
+class EventJournal:
+    """
+    Persists events as a snapshot (events.json) plus a journal of the
+        changes made since, one JSON record per line. Each change appends a
+        line instead of rewriting every event, the journal is folded back
+        into the snapshot every compact_every records.
+
+    Records are idempotent (add sets the whole event, remove and fired drop
+        it) so replaying a journal over a snapshot that already has some of
+        it, after a crash mid compaction, ends up the same.
+
+    All file I/O happens in the executor, one batch at a time so writes
+    land in order.
+    """
+
+    def __init__(self, loop, snapshot, compact_every=500,
+                 snapshot_path=EVENTS_PATH, journal_path=JOURNAL_PATH):
+        self.loop = loop
+        # Callable returning the current events, for compaction
+        self.snapshot = snapshot
+        self.compact_every = compact_every
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.records = 0
+        self._pending = []
+        self._compact = None
+        self._writing = False
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        # seq of the newest snapshot on disk, older batches are covered by it
+        self._snapshot_seq = -1
+
+    def load(self):
+        """
+        The events in the snapshot with the journal replayed on top.
+        """
+        events = fileIO(self.snapshot_path, 'load')
+        if not os.path.exists(self.journal_path):
+            return events
+        with open(self.journal_path, encoding='utf-8') as f:
+            for lineno, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Only the last line can be cut short by a crash
+                    log.warning('Stopped replaying the scheduler journal at'
+                                ' line {}'.format(lineno))
+                    # Counted so the caller compacts the broken line away
+                    self.records += 1
+                    break
+                self._apply(events, record)
+                self.records += 1
+        return events
+
+    @staticmethod
+    def _apply(events, record):
+        server = record['server']
+        if record['op'] == 'add':
+            events.setdefault(server, {})[record['name']] = record['event']
+        elif record['op'] == 'ran':
+            event = events.get(server, {}).get(record['name'])
+            if event is not None:
+                event['lastrun'] = record['time']
+        else:
+            events.get(server, {}).pop(record['name'], None)
+
+    def record(self, op, server, name, **data):
+        """
+        op is add (with the event's dict as event), ran (with the time it
+            was due as time), remove or fired.
+        """
+        record = {'op': op, 'server': server, 'name': name}
+        record.update(data)
+        self._pending.append(json.dumps(record) + '\n')
+        self.records += 1
+        if self.records >= self.compact_every:
+            self.compact()
+        else:
+            self._kick()
+
+    def _copy_events(self):
+        return {server: {name: dict(event)
+                         for name, event in per_server.items()}
+                for server, per_server in self.snapshot().items()}
+
+    def compact(self):
+        """
+        Writes a fresh snapshot and empties the journal, in the background.
+        """
+        self._compact = self._copy_events()
+        # Everything pending is in the snapshot already
+        self._pending = []
+        self.records = 0
+        self._kick()
+
+    def flush(self):
+        """
+        Writes a snapshot right away, for unloading. A batch still in the
+            executor is skipped when it sees the newer snapshot.
+        """
+        self._compact = None
+        self._pending = []
+        self.records = 0
+        self._write(next(self._seq), self._copy_events(), [])
 
-    def __lt__(self, other):
-        my_sig = "{}-{}-{}-{}".format(self.timedelta, self.name,
-                                      self.starttime, self.channel)
-        other_sig = "{}-{}-{}-{}".format(other.timedelta, other.name,
-                                         other.starttime, other.channel)
-        return hash(my_sig) < hash(other_sig)
+    def _kick(self):
+        if not self._writing:
+            self._writing = True
+            # Next loop turn, so a burst of changes goes out as one write
+            self.loop.call_soon(self._start)
+
+    def _start(self):
+        compact, self._compact = self._compact, None
+        lines, self._pending = self._pending, []
+        if compact is None and not lines:
+            self._writing = False
+            return
+        fut = self.loop.run_in_executor(None, self._write, next(self._seq),
+                                        compact, lines)
+        fut.add_done_callback(self._written)
+
+    def _written(self, fut):
+        self._writing = False
+        if fut.exception() is not None:
+            log.error('Failed to save scheduler events',
+                      exc_info=fut.exception())
+        if self._pending or self._compact is not None:
+            self._kick()
+
+    def _write(self, seq, compact, lines):
+        with self._lock:
+            if seq < self._snapshot_seq:
+                return
+            if compact is not None:
+                self._snapshot_seq = seq
+                dirname = os.path.dirname(self.snapshot_path)
+                fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(compact, f, indent=4, sort_keys=True)
+                os.replace(tmp, self.snapshot_path)
+                open(self.journal_path, 'w').close()
+            if lines:
+                with open(self.journal_path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(lines))
+
+
+class TokenBucket:
+    """
+    rate tokens a second up to capacity. Tokens can be taken before they're
+        there, the bucket goes negative and whoever comes next waits longer.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, now):
+        """
+        Takes a token, returns how long until it's actually there.
+        """
+        self._refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """
+    Spreads out scheduled runs that would hit the same channel or server at
+        once. Each channel and server has a TokenBucket, a run waits for a
+        token from both and gets up to jitter seconds more on top when it had
+        to wait so runs that collided don't stay lined up.
+    """
+
+    def __init__(self, settings):
+        self.channel_rate = settings.get('CHANNEL_RATE', 1.0)
+        self.channel_burst = settings.get('CHANNEL_BURST', 5)
+        self.server_rate = settings.get('SERVER_RATE', 2.0)
+        self.server_burst = settings.get('SERVER_BURST', 10)
+        self.jitter = settings.get('JITTER', 2.0)
+        self.channels = {}
+        self.servers = {}
+        self.delayed = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def _reserve(self, buckets, key, rate, burst, now):
+        try:
+            bucket = buckets[key]
+        except KeyError:
+            bucket = buckets[key] = TokenBucket(rate, burst, now)
+        return bucket.reserve(now)
+
+    def delay(self, event, now):
+        """
+        How long event should wait before it runs, 0 to run right away.
+        """
+        delay = max(self._reserve(self.channels, event.channel,
+                                  self.channel_rate, self.channel_burst, now),
+                    self._reserve(self.servers, event.server,
+                                  self.server_rate, self.server_burst, now))
+        if delay > 0:
+            delay += uniform(0, self.jitter)
+            self.delayed += 1
+            self.total_delay += delay
+            self.max_delay = max(self.max_delay, delay)
+        return delay
+
+    def prune(self, now):
+        """
+        Forgets buckets that are full again, they'd start out the same.
+        """
+        for buckets in (self.channels, self.servers):
+            for key in [k for k, b in buckets.items() if b.idle(now)]:
+                del buckets[key]
 
 
 class Scheduler:
@@ -42,27 +538,92 @@ class Scheduler:
 
     def __init__(self, bot):
         self.bot = bot
-        self.events = fileIO('data/scheduler/events.json', 'load')
-        self.queue = asyncio.PriorityQueue(loop=self.bot.loop)
-        self.queue_lock = asyncio.Lock()
-        self.to_kill = {}
+        self.journal = EventJournal(self.bot.loop, lambda: self.events)
+        self.events = self.journal.load()
+        if self.journal.records:
+            self.journal.compact()
+        self.settings = fileIO('data/scheduler/settings.json', 'load')
+        self.queue = self._make_queue(self.settings.get('BACKEND'))
+        # Set to make queue_manager look at the queue before its deadline
+        self.wakeup = asyncio.Event(loop=self.bot.loop)
+        self.next_deadline = None
+        self.limiter = RateLimiter(self.settings)
+        # Caps how many scheduled commands are being processed at once
+        self.running = asyncio.Semaphore(
+            self.settings.get('MAX_CONCURRENT', 5), loop=self.bot.loop)
+        # ((server, name), due time) -> call_later handle of a run held back
+        #   by limiter, one event can have several with catch-up
+        self.delayed = {}
         self._load_events()
+        self.manager_task = self.bot.loop.create_task(self.queue_manager())
 
-    def save_events(self):
-        fileIO('data/scheduler/events.json', 'save', self.events)
-        log.debug('saved events:\n\t{}'.format(self.events))
+    def __unload(self):
+        self.manager_task.cancel()
+        for handle in self.delayed.values():
+            handle.cancel()
+        self.journal.flush()
+
+    def _make_queue(self, backend):
+        if backend == 'wheel':
+            return TimingWheel()
+        return EventQueue()
 
     def _load_events(self):
-        # for entry in the self.events make an Event
+        """
+        Plans the next run of every stored event in one pass, catching up
+            on runs missed while the bot was down, and builds the queue at
+            once.
+        """
+        now = time.time()
+        planned = []
         for server in self.events:
-            for name, event in self.events[server].items():
+            for name, event in list(self.events[server].items()):
                 ret = {}
                 ret['server'] = server
                 ret.update(event)
                 e = Event(ret)
-                self.bot.loop.create_task(self._put_event(e))
+                fut = self._plan(e, now)
+                if fut is None:
+                    del self.events[server][name]
+                    self.journal.record('fired', server, name)
+                else:
+                    planned.append((fut, e))
+        self.queue.load(planned)
+        log.debug('Planned {} events'.format(len(planned)))
+
+    def _plan(self, event, now):
+        """
+        When event should run next after a restart at now, None if it should
+            be dropped. Repeating events run at starttime + k * timedelta,
+            events saved without a starttime count from now.
+        """
+        policy = event.catchup or self.settings.get('CATCHUP', 'once')
+        start = event.starttime if event.starttime is not None else now
+        if not event.repeat:
+            fut = start + event.timedelta
+            if fut > now:
+                return fut
+            return None if policy == 'skip' else now
 
-    async def _put_event(self, event, fut=None, offset=None):
+        delta = event.timedelta
+        # First run still ahead of us
+        upcoming = max(0, floor((now - start) / delta) + 1)
+        if event.lastrun is None:
+            # Saved before runs were recorded, nothing is known to be missed
+            done = upcoming - 1
+        else:
+            done = floor((event.lastrun - start) / delta)
+        missed = upcoming - 1 - done
+        if missed <= 0 or policy == 'skip':
+            return start + upcoming * delta
+        elif policy == 'all':
+            missed = min(missed, self.settings.get('CATCHUP_CAP', 10))
+            event.catching_up = True
+            return start + (upcoming - missed) * delta
+        # once, the latest missed run
+        return start + (upcoming - 1) * delta
+
+    async def _put_event(self, event, fut=None):
         if fut is None:
             now = int(time.time())
             if event.repeat:
@@ -71,9 +632,9 @@ class Scheduler:
                        event.starttime)
             else:
                 fut = now + event.timedelta
-        if offset:
-            fut += offset
-        await self.queue.put((fut, event))
+        self.queue.push(fut, event)
+        if self.next_deadline is None or fut < self.next_deadline:
+            self.wakeup.set()
         log.debug('Added "{}" to the scheduler queue at {}'.format(event.name,
                                                                    fut))
 
@@ -106,19 +667,15 @@ class Scheduler:
         e = Event(event_dict.copy())
         await self._put_event(e)
 
-        self.save_events()
+        self.journal.record('add', dest_server, name,
+                            event=self.events[dest_server][name])
 
     async def _remove_event(self, name, server):
-        await self.queue_lock.acquire()
-        events = []
-        while self.queue.qsize() != 0:
-            time, event = await self.queue.get()
-            if not (name == event.name and server.id == event.server):
-                events.append((time, event))
-
-        for event in events:
-            await self.queue.put(event)
-        self.queue_lock.release()
+        for key, when in list(self.delayed):
+            if key == (server.id, name):
+                self.delayed.pop((key, when)).cancel()
+        if self.queue.remove(server.id, name):
+            self.wakeup.set()
 
     @commands.group(no_pm=True, pass_context=True)
     @checks.mod_or_permissions(manage_messages=True)
@@ -197,9 +754,34 @@ class Scheduler:
 
         del self.events[server.id][name]
         await self._remove_event(name, server)
-        self.save_events()
-        await self.bot.say('"{}" has successfully been removed but'
-                           ' it may run once more.'.format(name))
+        self.journal.record('remove', server.id, name)
+        await self.bot.say('"{}" has successfully been removed.'.format(name))
+
+    @scheduler.command(pass_context=True, name="catchup")
+    async def _scheduler_catchup(self, ctx, name, policy):
+        """Sets what happens to runs missed while the bot was down
+
+        skip drops them, once runs the latest of them and all runs each of
+        them (up to a cap)."""
+        server = ctx.message.server
+        name = name.lower()
+        policy = policy.lower()
+        if name not in self.events.get(server.id, {}):
+            await self.bot.say('That event does not exist on this server.')
+            return
+        if policy not in ('skip', 'once', 'all'):
+            await self.bot.send_cmd_help(ctx)
+            return
+
+        self.events[server.id][name]['catchup'] = policy
+        event = self.queue.find(server.id, name)
+        if event is not None:
+            event.catchup = policy
+        self.journal.record('add', server.id, name,
+                            event=self.events[server.id][name])
+        await self.bot.say('Missed runs of "{}" will {}.'.format(
+            name, {'skip': 'be skipped', 'once': 'run once',
+                   'all': 'all run'}[policy]))
 
     @scheduler.command(pass_context=True, name="list")
     async def _scheduler_list(self, ctx):
@@ -216,6 +798,69 @@ class Scheduler:
         mess += "\n\t".join(sorted(self.events[server.id].keys()))
         await self.bot.say(box(mess))
 
+    @scheduler.command(name="backend")
+    @checks.is_owner()
+    async def _scheduler_backend(self, backend=None):
+        """Shows or sets how events are queued, heap or wheel
+
+        wheel scales better with tens of thousands of events"""
+        current = self.settings.get('BACKEND', 'heap')
+        if backend is None:
+            await self.bot.say('The scheduler uses the {} backend with {}'
+                               ' events queued.'.format(current,
+                                                        len(self.queue)))
+            return
+        backend = backend.lower()
+        if backend not in ('heap', 'wheel'):
+            await self.bot.say('Backend must be heap or wheel.')
+            return
+
+        queue = self._make_queue(backend)
+        for when, event in sorted(self.queue.items(),
+                                  key=lambda item: item[0]):
+            queue.push(when, event)
+        self.queue = queue
+        self.settings['BACKEND'] = backend
+        fileIO('data/scheduler/settings.json', 'save', self.settings)
+        self.wakeup.set()
+        await self.bot.say('The scheduler now uses the {} backend.'.format(
+            backend))
+
+    @scheduler.command(name="status")
+    @checks.is_owner()
+    async def _scheduler_status(self):
+        """Shows how many events are queued and how much runs were delayed
+        """
+        limiter = self.limiter
+        avg = limiter.total_delay / limiter.delayed if limiter.delayed else 0
+        mess = ("Backend: {}\n"
+                "Queued events: {}\n"
+                "Runs held back right now: {}\n"
+                "Runs delayed by rate limits: {}\n"
+                "Average delay: {:.1f}s\n"
+                "Longest delay: {:.1f}s").format(
+                    self.settings.get('BACKEND', 'heap'), len(self.queue),
+                    len(self.delayed), limiter.delayed, avg,
+                    limiter.max_delay)
+        await self.bot.say(box(mess))
+
+    @scheduler.command(name="dispatch")
+    @checks.is_owner()
+    async def _scheduler_dispatch(self, on_off: bool=None):
+        """Shows or sets whether events run as full messages
+
+        When on, every scheduled run also goes through all on_message
+        listeners instead of just the command."""
+        if on_off is None:
+            on_off = self.settings.get('DISPATCH', False)
+            await self.bot.say('Scheduled events {} dispatched as messages.'
+                               .format('are' if on_off else 'are not'))
+            return
+        self.settings['DISPATCH'] = on_off
+        fileIO('data/scheduler/settings.json', 'save', self.settings)
+        await self.bot.say('Scheduled events will {}be dispatched as'
+                           ' messages.'.format('' if on_off else 'no longer '))
+
     def _parse_time(self, time):
         translate = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
         timespec = time[-1]
@@ -224,6 +869,36 @@ class Scheduler:
         timeint = int(time[:-1])
         return timeint * translate.get(timespec)
 
+    def _get_message(self, event, channel, prefix):
+        """
+        Copy of the fake message event runs as. The message is only built on
+            the first run, or again when the channel or prefix changed. The
+            author is looked up on every run so one who left the server runs
+            as a bare User again, like a freshly built message would.
+        """
+        content = prefix + event.command
+        template = event.message
+        if template is None or template.channel != channel or \
+                template.content != content:
+            data = {}
+            data['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%S%z",
+                                              time.gmtime())
+            data['id'] = randint(10**(17), (10**18) - 1)
+            data['content'] = content
+            data['channel'] = channel
+            data['author'] = {'id': event.author}
+            data['nonce'] = randint(-2**32, (2**32) - 1)
+            data['channel_id'] = event.channel
+            data['reactions'] = []
+            template = event.message = discord.Message(**data)
+        message = copy.copy(template)
+        message.timestamp = datetime.datetime.utcnow()
+        member = channel.server.get_member(event.author)
+        if member is None:
+            member = discord.User(id=event.author)
+        message.author = member
+        return message
+
     def run_coro(self, event):
         channel = self.bot.get_channel(event.channel)
         try:
@@ -232,64 +907,96 @@ class Scheduler:
         except AttributeError:
             log.debug("Channel no longer found, not running scheduled event.")
             return
-        data = {}
-        data['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.gmtime())
-        data['id'] = randint(10**(17), (10**18) - 1)
-        data['content'] = prefix + event.command
-        data['channel'] = self.bot.get_channel(event.channel)
-        data['author'] = {'id': event.author}
-        data['nonce'] = randint(-2**32, (2**32) - 1)
-        data['channel_id'] = event.channel
-        data['reactions'] = []
-        fake_message = discord.Message(**data)
-        # coro = self.bot.process_commands(fake_message)
+        fake_message = self._get_message(event, channel, prefix)
         log.info("Running '{}' in {}".format(event.name, event.server))
-        # self.bot.loop.create_task(coro)
-        self.bot.dispatch('message', fake_message)
+        if self.settings.get('DISPATCH', False):
+            # Goes through every on_message listener like a real message
+            self.bot.dispatch('message', fake_message)
+        else:
+            self.bot.loop.create_task(self._invoke(fake_message))
+
+    async def _invoke(self, message):
+        # Red's on_message drops messages of blacklisted (or not whitelisted)
+        #   users and in ignored channels and servers before they get here
+        if not self.bot.user_allowed(message):
+            log.info("Not running '{}' in {}, its author or channel is"
+                     " ignored".format(message.content, message.channel.id))
+            return
+        with (await self.running):
+            await self.bot.process_commands(message)
+
+    def _run_later(self, event, when):
+        self.delayed.pop((event.key, when), None)
+        self.run_coro(event)
+        self._mark_ran(event, when)
+
+    def _mark_ran(self, event, when):
+        """
+        Journals that the run of event due at when happened, so a restart
+            doesn't plan it again.
+        """
+        stored = self.events.get(event.server, {}).get(event.name)
+        if stored is None or stored.get('starttime') != event.starttime:
+            # Removed, or replaced by a new event of the same name
+            return
+        if not event.repeat:
+            del self.events[event.server][event.name]
+            self.journal.record('fired', event.server, event.name)
+        elif stored.get('lastrun') is None or when > stored['lastrun']:
+            # Held back runs can finish out of order
+            stored['lastrun'] = when
+            self.journal.record('ran', event.server, event.name, time=when)
+
+    def _run_due(self):
+        """
+        Runs every event whose time has come and requeues the repeating ones.
+            Returns how long until the next event, None if there is none.
+        """
+        now = time.time()
+        due = self.queue.pop_due(now)
+        for next_time, next_event in due:
+            delay = self.limiter.delay(next_event, now)
+            if delay > 0:
+                log.info("Holding back '{}' in {} for {:.1f}s".format(
+                    next_event.name, next_event.server, delay))
+                key = (next_event.key, next_time)
+                self.delayed[key] = self.bot.loop.call_later(
+                    delay, self._run_later, next_event, next_time)
+            else:
+                self.run_coro(next_event)
+                self._mark_ran(next_event, next_time)
+            if next_event.repeat:
+                delta = next_event.timedelta
+                if next_event.catching_up and next_time + delta <= now:
+                    self.queue.push(next_time + delta, next_event)
+                else:
+                    # Runs missed while we were busy are skipped
+                    next_event.catching_up = False
+                    missed = (now - next_time) // delta + 1
+                    self.queue.push(next_time + missed * delta, next_event)
+        if due and len(self.limiter.channels) > 1000:
+            self.limiter.prune(now)
+        self.next_deadline = self.queue.next_time()
+        if self.next_deadline is None:
+            return None
+        return max(self.next_deadline - time.time(), 0)
 
     async def queue_manager(self):
+        """
+        Sleeps until the earliest event is due, _put_event and _remove_event
+            wake it up early when that changes.
+        """
         while self == self.bot.get_cog('Scheduler'):
-            await self.queue_lock.acquire()
-            if self.queue.qsize() != 0:
-                curr_time = int(time.time())
-                next_tuple = await self.queue.get()
-                next_time = next_tuple[0]
-                next_event = next_tuple[1]
-                diff = next_time - curr_time
-                diff = diff if diff >= 0 else 0
-                if diff < 30:
-                    log.debug('scheduling call of "{}" in {}s'.format(
-                        next_event.name, diff))
-                    fut = self.bot.loop.call_later(diff, self.run_coro,
-                                                   next_event)
-                    self.to_kill[next_time] = fut
-                    if next_event.repeat:
-                        await self._put_event(next_event, next_time,
-                                              next_event.timedelta)
-                    else:
-                        del self.events[next_event.server][next_event.name]
-                        self.save_events()
-                else:
-                    log.debug('Will run {} "{}" in {}s'.format(
-                        next_event.name, next_event.command, diff))
-                    await self._put_event(next_event, next_time)
-            self.queue_lock.release()
-
-            to_delete = []
-            for start_time, old_command in self.to_kill.items():
-                if time.time() > start_time + 30:
-                    old_command.cancel()
-                    to_delete.append(start_time)
-            for item in to_delete:
-                del self.to_kill[item]
-
-            await asyncio.sleep(5)
+            self.wakeup.clear()
+            delay = self._run_due()
+            if delay is not None:
+                log.debug('next event in {:.2f}s'.format(delay))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay,
+                                       loop=self.bot.loop)
+            except asyncio.TimeoutError:
+                pass
         log.debug('manager dying')
-        while self.queue.qsize() != 0:
-            await self.queue.get()
-        while len(self.to_kill) != 0:
-            curr = self.to_kill.pop()
-            curr.cancel()
 
 
 def check_folder():
@@ -298,15 +1005,21 @@ def check_folder():
 
 
 def check_files():
-    f = 'data/scheduler/events.json'
+    f = EVENTS_PATH
     if not os.path.exists(f):
         fileIO(f, 'save', {})
 
+    f = 'data/scheduler/settings.json'
+    if not os.path.exists(f):
+        fileIO(f, 'save', {'BACKEND': 'heap', 'DISPATCH': False,
+                           'CATCHUP': 'once', 'CATCHUP_CAP': 10,
+                           'CHANNEL_RATE': 1.0, 'CHANNEL_BURST': 5,
+                           'SERVER_RATE': 2.0, 'SERVER_BURST': 10,
+                           'JITTER': 2.0, 'MAX_CONCURRENT': 5})
+
 
 def setup(bot):
     check_folder()
     check_files()
     n = Scheduler(bot)
-    loop = asyncio.get_event_loop()
-    loop.create_task(n.queue_manager())
     bot.add_cog(n)
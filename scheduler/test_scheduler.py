@@ -0,0 +1,421 @@
+"""
+Tests for the Scheduler cog. Nothing connects to Discord.
+
+Run them from the root of a Red install (cogs.utils has to be importable)
+    with discord.py and pytest installed:
+
+    python -m pytest path/to/scheduler/test_scheduler.py
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+pytest.importorskip("discord")
+pytest.importorskip("cogs.utils.dataIO")
+
+import scheduler
+
+
+class FakeSettings:
+    def get_prefixes(self, server):
+        return ["!"]
+
+
+class FakeServer:
+    def __init__(self, id):
+        self.id = id
+        self.members = {}
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+
+class FakeChannel:
+    def __init__(self, id, server):
+        self.id = id
+        self.server = server
+        self.is_private = False
+
+
+class FakeMember:
+    def __init__(self, id):
+        self.id = id
+        self.roles = []
+
+
+class FakeMessage:
+    def __init__(self, content, channel):
+        self.content = content
+        self.channel = channel
+
+
+class FakeBot:
+    """
+    Just what the cog uses. get_cog returning None stops queue_manager right
+        away, the tests run the queue through _run_due themselves.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.settings = FakeSettings()
+        self.allowed = True
+        self.channels = {}
+        self.invoked = []
+        self.dispatched = []
+
+    def get_cog(self, name):
+        return None
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def user_allowed(self, message):
+        return self.allowed
+
+    async def process_commands(self, message):
+        self.invoked.append(message)
+
+    def dispatch(self, event, *args):
+        self.dispatched.append((event,) + args)
+
+
+def make_event(name="ping", server="1", channel="10", repeat=True,
+               timedelta=60, starttime=0, lastrun=None):
+    return scheduler.Event({"name": name, "channel": channel,
+                            "server": server, "author": "2",
+                            "command": name, "timedelta": timedelta,
+                            "repeat": repeat, "starttime": starttime,
+                            "lastrun": lastrun})
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def bot(tmpdir, monkeypatch, loop):
+    """
+    A bot with a fresh data/scheduler in the current directory.
+    """
+    monkeypatch.chdir(str(tmpdir))
+    tmpdir.mkdir("data")
+    scheduler.check_folder()
+    scheduler.check_files()
+    bot = FakeBot(loop)
+    server = FakeServer("1")
+    bot.channels["10"] = FakeChannel("10", server)
+    return bot
+
+
+@pytest.fixture
+def cog(bot, monkeypatch, loop):
+    cog = scheduler.Scheduler(bot)
+    # Direct mode only needs the content and channel of the fake message
+    monkeypatch.setattr(cog, "_get_message",
+                        lambda event, channel, prefix:
+                        FakeMessage(prefix + event.command, channel))
+    yield cog
+    cog.manager_task.cancel()
+    loop.run_until_complete(asyncio.sleep(0))
+
+
+def test_direct_invoke(cog, loop):
+    cog.run_coro(make_event())
+    loop.run_until_complete(asyncio.sleep(0))
+    assert [m.content for m in cog.bot.invoked] == ["!ping"]
+    assert cog.bot.dispatched == []
+
+
+def test_direct_invoke_skips_ignored(cog, loop):
+    cog.bot.allowed = False
+    cog.run_coro(make_event())
+    loop.run_until_complete(asyncio.sleep(0))
+    assert cog.bot.invoked == []
+
+
+def test_message_author_follows_membership(cog):
+    channel = cog.bot.channels["10"]
+    member = channel.server.members["2"] = FakeMember("2")
+    event = make_event()
+
+    def author():
+        # The real one, the fixture stubs it out on the instance
+        message = scheduler.Scheduler._get_message(cog, event, channel, "!")
+        return message.author
+
+    assert author() is member
+    del channel.server.members["2"]
+    left = author()
+    assert not isinstance(left, FakeMember) and left.id == "2"
+    # The template is reused, only the author changed
+    assert event.message is not None and author() is not member
+    back = channel.server.members["2"] = FakeMember("2")
+    assert author() is back
+
+
+def test_dispatch_mode(cog, loop):
+    cog.settings["DISPATCH"] = True
+    cog.run_coro(make_event())
+    loop.run_until_complete(asyncio.sleep(0))
+    assert cog.bot.invoked == []
+    assert [d[0] for d in cog.bot.dispatched] == ["message"]
+
+
+def drain(queue, times):
+    return [[(when, event.key) for when, event in queue.pop_due(now)]
+            for now in times]
+
+
+def test_wheel_pops_like_heap():
+    rng = random.Random(0)
+    start = 1000000.5
+    heap = scheduler.EventQueue()
+    wheel = scheduler.TimingWheel(now=start)
+    for i in range(2000):
+        # Seconds to three days out, with plenty of ties
+        when = start + rng.choice([rng.randrange(120),
+                                   rng.uniform(0, 3 * 86400)])
+        event = make_event(name="e{}".format(i))
+        heap.push(when, event)
+        wheel.push(when, event)
+
+    now = start
+    times = []
+    while now < start + 3 * 86400 + 60:
+        now += rng.choice([0.5, 1, 7, 59, 61, 600, 3599, 3601])
+        times.append(now)
+    popped = drain(wheel, times)
+    assert popped == drain(heap, times)
+    assert sum(len(p) for p in popped) == 2000
+    assert len(wheel) == 0 and wheel.next_time() is None
+
+
+def test_wheel_rollover():
+    start = 86400 * 10
+    wheel = scheduler.TimingWheel(now=start)
+    when = start + 86400 + 3600 + 61.5
+    wheel.push(when, make_event())
+    assert wheel._index[("1", "ping")][3] == 3  # day wheel
+
+    # Cascades through the hour, minute and second wheels on the way
+    for now in (start + 86400, start + 86400 + 3600,
+                start + 86400 + 3600 + 60, when - 0.5):
+        assert wheel.pop_due(now) == []
+        assert wheel.next_time() <= when
+    assert wheel._index[("1", "ping")][3] == 0
+    assert wheel.next_time() == when
+    assert [w for w, _ in wheel.pop_due(when)] == [when]
+
+
+def test_wheel_remove_and_reschedule():
+    start = 5000
+    wheel = scheduler.TimingWheel(now=start)
+    keep = make_event(name="keep")
+    gone = make_event(name="gone")
+    moved = make_event(name="moved")
+    for event in (keep, gone, moved):
+        wheel.push(start + 7200, event)
+    # Cascade them into the minute wheel before touching them
+    assert wheel.pop_due(start + 3600) == []
+
+    assert wheel.remove("1", "gone")
+    assert not wheel.remove("1", "gone")
+    assert wheel.find("1", "gone") is None
+    wheel.push(start + 30, moved)
+    assert len(wheel) == 2
+
+    assert [e.name for _, e in wheel.pop_due(start + 30)] == ["moved"]
+    assert [e.name for _, e in wheel.pop_due(start + 7200)] == ["keep"]
+    assert len(wheel) == 0
+
+
+def test_wheel_pending_heap_has_no_duplicates():
+    start = 5000
+    wheel = scheduler.TimingWheel(now=start)
+    event = make_event()
+    # Far out enough for the day wheel, same bucket every time
+    for _ in range(100):
+        wheel.push(start + 3 * 86400, event)
+        wheel.remove(*event.key)
+    wheel.push(start + 3 * 86400, event)
+    assert wheel._pending[3] == [int((start + 3 * 86400) // 86400)]
+    assert len(wheel.pop_due(start + 3 * 86400)) == 1
+    assert wheel._pending == [[], [], [], []]
+
+
+def stored_event(name="ping", repeat=True, timedelta=60, starttime=0,
+                 **extra):
+    """
+    An event as events.json has it.
+    """
+    event = {"name": name, "channel": "10", "author": "2", "command": name,
+             "timedelta": timedelta, "repeat": repeat, "starttime": starttime}
+    event.update(extra)
+    return event
+
+
+def settle(loop, journal):
+    """
+    Runs the loop until the journal has nothing left to write.
+    """
+    while journal._writing:
+        loop.run_until_complete(asyncio.sleep(0.01))
+
+
+@pytest.fixture
+def paths(tmpdir):
+    return str(tmpdir.join("events.json")), str(tmpdir.join("events.journal"))
+
+
+def write_files(paths, snapshot, lines):
+    with open(paths[0], "w") as f:
+        json.dump(snapshot, f)
+    with open(paths[1], "w") as f:
+        f.write("".join(lines))
+
+
+def make_journal(loop, paths, events, **kwargs):
+    return scheduler.EventJournal(loop, lambda: events,
+                                  snapshot_path=paths[0],
+                                  journal_path=paths[1], **kwargs)
+
+
+def test_journal_replays_over_snapshot(loop, paths):
+    write_files(paths, {"1": {"a": stored_event("a"),
+                              "b": stored_event("b")}}, [
+        json.dumps({"op": "add", "server": "2", "name": "c",
+                    "event": stored_event("c")}) + "\n",
+        json.dumps({"op": "ran", "server": "1", "name": "a",
+                    "time": 120}) + "\n",
+        json.dumps({"op": "remove", "server": "1", "name": "b"}) + "\n",
+        # Records of events that are gone already change nothing
+        json.dumps({"op": "ran", "server": "1", "name": "b",
+                    "time": 120}) + "\n",
+        json.dumps({"op": "fired", "server": "3", "name": "x"}) + "\n"])
+
+    journal = make_journal(loop, paths, None)
+    events = journal.load()
+    assert events == {"1": {"a": stored_event("a", lastrun=120)},
+                      "2": {"c": stored_event("c")}}
+    assert journal.records == 5
+
+
+def test_journal_round_trip(loop, paths):
+    write_files(paths, {}, [])
+    events = {}
+    journal = make_journal(loop, paths, events)
+    events["1"] = {"a": stored_event("a"), "b": stored_event("b")}
+    journal.record("add", "1", "a", event=events["1"]["a"])
+    journal.record("add", "1", "b", event=events["1"]["b"])
+    events["1"]["a"]["lastrun"] = 60
+    journal.record("ran", "1", "a", time=60)
+    del events["1"]["b"]
+    journal.record("remove", "1", "b")
+    settle(loop, journal)
+
+    with open(paths[0]) as f:
+        assert json.load(f) == {}
+    assert make_journal(loop, paths, None).load() == events
+
+
+def test_journal_compacts(loop, paths):
+    write_files(paths, {}, [])
+    events = {"1": {}}
+    journal = make_journal(loop, paths, events, compact_every=3)
+    for name in ("a", "b", "c", "d"):
+        events["1"][name] = stored_event(name)
+        journal.record("add", "1", name, event=events["1"][name])
+    settle(loop, journal)
+
+    # The third record folded a, b and c into the snapshot
+    assert journal.records == 1
+    with open(paths[0]) as f:
+        assert sorted(json.load(f)["1"]) == ["a", "b", "c"]
+    with open(paths[1]) as f:
+        assert [json.loads(line)["name"] for line in f] == ["d"]
+    assert make_journal(loop, paths, None).load() == events
+
+    journal.flush()
+    with open(paths[0]) as f:
+        assert json.load(f) == events
+    assert os.path.getsize(paths[1]) == 0
+
+
+def test_journal_truncated_last_line(loop, paths):
+    good = json.dumps({"op": "add", "server": "1", "name": "a",
+                       "event": stored_event("a")}) + "\n"
+    torn = json.dumps({"op": "add", "server": "1", "name": "b",
+                       "event": stored_event("b")})[:25]
+    write_files(paths, {}, [good, torn])
+
+    journal = make_journal(loop, paths, None)
+    events = journal.load()
+    assert events == {"1": {"a": stored_event("a")}}
+    # The torn line counts, so the cog compacts it away on startup
+    assert journal.records == 2
+    journal.snapshot = lambda: events
+    journal.compact()
+    events["1"]["c"] = stored_event("c")
+    journal.record("add", "1", "c", event=events["1"]["c"])
+    settle(loop, journal)
+
+    assert make_journal(loop, paths, None).load() == events
+
+
+def test_upgrade_from_events_without_lastrun(bot, loop):
+    now = time.time()
+    old = {"1": {"every": stored_event("every", starttime=now - 605,
+                                       timedelta=60),
+                 "once": stored_event("once", repeat=False,
+                                      starttime=now - 30, timedelta=60)}}
+    with open(scheduler.EVENTS_PATH, "w") as f:
+        json.dump(old, f)
+
+    cog = scheduler.Scheduler(bot)
+    cog.manager_task.cancel()
+    try:
+        assert cog.events == old
+        planned = {event.name: when for when, event in cog.queue.items()}
+        # No lastrun means nothing is known to be missed, no catch-up
+        assert planned == {"every": now - 605 + 11 * 60, "once": now + 30}
+
+        cog._mark_ran(cog.queue.find("1", "every"), now - 5)
+        settle(loop, cog.journal)
+        events = make_journal(loop, (scheduler.EVENTS_PATH,
+                                     scheduler.JOURNAL_PATH), None).load()
+        assert events["1"]["every"]["lastrun"] == now - 5
+        assert "lastrun" not in events["1"]["once"]
+    finally:
+        loop.run_until_complete(asyncio.sleep(0))
+
+
+def test_load_events_without_starttime(bot, loop):
+    now = time.time()
+    old = {"1": {"every": stored_event("every", timedelta=60),
+                 "once": stored_event("once", repeat=False, timedelta=60)}}
+    for event in old["1"].values():
+        del event["starttime"]
+    with open(scheduler.EVENTS_PATH, "w") as f:
+        json.dump(old, f)
+
+    cog = scheduler.Scheduler(bot)
+    cog.manager_task.cancel()
+    try:
+        planned = {event.name: when for when, event in cog.queue.items()}
+        assert planned.keys() == {"every", "once"}
+        assert all(now + 60 <= when <= time.time() + 60
+                   for when in planned.values())
+    finally:
+        loop.run_until_complete(asyncio.sleep(0))